@@ -27,9 +27,9 @@ THE SOFTWARE.
 
 
 from argparse import ArgumentParser
+import json
 import logging
 from .dnsyo import lookup as dnsyo
-from .updater import update
 import sys
 
 
@@ -48,16 +48,84 @@ def run():
         ['resolverfile', 'store',
          'Location of the local yaml resolvers file',
          '~/.dnsyo-resolvers-list.yaml'],
+        ['healthfile', 'store',
+         'Where to keep track of which servers respond well',
+         '~/.dnsyo-health.json'],
+        ['nohealth', 'store_true',
+         'Don\'t use or update the server health file'],
         ['verbose:v', 'store_true', 'Extended debug info'],
         ['simple:s', 'store_true',
          'Simple output mode (good for UNIX parsing)'],
         ['extended:x', 'store_true',
          'Extended output mode including server addresses'],
-        ['threads:t', 'store', 'Number of worker threads to use', 100],
+        ['stream', 'store_true',
+         'Simple output mode, written as each server responds'],
+        ['json:j', 'store_true',
+         'Write one line of JSON per server as it responds'],
+        ['threads:t', 'store',
+         'Maximum number of queries in flight, fewer are used if packets '
+         'are being lost', 100],
+        ['rate', 'store',
+         'Maximum packets to send per second'],
+        ['processes:P', 'store',
+         'Split big runs across this many processes', 1],
         ['servers:q', 'store',
          'Maximum number of servers to query (or ALL)', 500],
         ['country:c', 'store',
-         'Query servers by two letter country code'],
+         'Query servers by two letter country code (comma separated)'],
+        ['provider', 'store',
+         'Only query servers from these providers or AS names '
+         '(comma separated)'],
+        ['excludeProvider', 'store',
+         'Don\'t query servers from these providers or AS names '
+         '(comma separated)'],
+        ['excludePrefix', 'store',
+         'Don\'t query servers in these networks, e.g. 192.0.2.0/24 '
+         '(comma separated)'],
+        ['family', 'store',
+         'Only query IPv4 (4) or IPv6 (6) servers'],
+        ['agreement', 'store',
+         'Stop as soon as it\'s clear whether this fraction of servers '
+         'agree on an answer (e.g. 0.95)'],
+        ['minSamples', 'store',
+         'Responses needed before stopping early with --agreement', 30],
+        ['confidence', 'store',
+         'Confidence needed before stopping early with --agreement', 0.95],
+        ['watch:w', 'store',
+         'Query again every this many seconds until the change in --expect '
+         'has propagated'],
+        ['expect', 'store',
+         'The answer to wait for with --watch (| separated)'],
+        ['target', 'store',
+         'Fraction of servers that need the expected answer before '
+         '--watch stops', 1.0],
+        ['agents', 'store',
+         'Send the queries from these agents instead (host:port, comma '
+         'separated)'],
+        ['agent', 'store',
+         'Run as an agent, taking queries from a coordinator on this '
+         '[host:]port'],
+        ['agentKey', 'store',
+         'Shared key between the coordinator and its agents'],
+        ['daemon', 'store',
+         'Keep running, answering lookups over HTTP on this [host:]port'],
+        ['stats', 'store',
+         'Write how long each part of the run took, and server response '
+         'times, to this JSON file (- for stdout)'],
+        ['prometheus', 'store',
+         'Write the same stats to this Prometheus textfile'],
+        ['history', 'store',
+         'Save every server\'s answer to this SQLite file, to compare runs '
+         'later with --diff'],
+        ['runs', 'store_true',
+         'List the runs saved in --history (for the domain and type, if '
+         'given)'],
+        ['diff', 'store',
+         'Show the servers whose answer changed between two runs in '
+         '--history, OLD[,NEW] where each is a run number or an age like 30m, '
+         '2h or 1d (NEW defaults to the latest run)'],
+        ['batch:b', 'store',
+         'File of "domain [type]" lines to query together (- for stdin)'],
         ['update', 'store_true',
          'Check the list for working servers'],
         ['updateSummary', 'store',
@@ -108,10 +176,39 @@ def run():
     opts = p.parse_args()
 
     # Dirty hack to get around --update not needing domain or record
-    if not opts.update and not opts.domain:
+    if not opts.update and not opts.batch and not opts.agent and \
+            not opts.daemon and not opts.runs and not opts.diff and \
+            not opts.domain:
         p.error("You must provide a domain!")
         sys.exit(3)
 
+    if opts.batch and opts.stream:
+        p.error("Stream output can't be used with --batch, try --json")
+        sys.exit(3)
+
+    if opts.watch and (opts.batch or opts.stream or opts.json):
+        p.error("--watch can't be used with --batch, --stream or --json")
+        sys.exit(3)
+
+    if opts.watch and not opts.expect:
+        p.error("--watch needs the answer to wait for in --expect")
+        sys.exit(3)
+
+    if (opts.runs or opts.diff) and not opts.history:
+        p.error("--runs and --diff need the --history file to look in")
+        sys.exit(3)
+
+    try:
+        agreement = float(opts.agreement) if opts.agreement else None
+        minSamples = int(opts.minSamples)
+        confidence = float(opts.confidence)
+        watch = float(opts.watch) if opts.watch else None
+        target = float(opts.target)
+    except ValueError:
+        p.error("--agreement, --minSamples, --confidence, --watch and "
+                "--target must be numbers")
+        sys.exit(3)
+
     # Setup logging
     if len(logging.root.handlers) == 0:  # Only if there aren't any loggers
         if opts.verbose:
@@ -119,7 +216,7 @@ def run():
             logging.basicConfig(
                 level=logging.DEBUG
             )
-        elif opts.simple:
+        elif opts.simple or opts.stream or opts.json:
             # If the simple option is passed only output warnings and errors
             logging.basicConfig(
                 level=logging.WARNING
@@ -133,26 +230,90 @@ def run():
         logging.debug("Debug logging enabled")
 
     # Prepare the lookup request
+    settings = dict(
+        listLocation=opts.resolverlist,
+        listLocal=opts.resolverfile,
+        expected=opts.expect,
+        maxWorkers=opts.threads,
+        maxServers=opts.servers,
+        country=opts.country,
+        providers=opts.provider,
+        excludeProviders=opts.excludeProvider,
+        excludePrefixes=opts.excludePrefix,
+        family=opts.family,
+        healthFile=None if opts.nohealth else opts.healthfile,
+        maxRate=opts.rate,
+        processes=opts.processes,
+        historyFile=opts.history
+    )
     try:
         lookup = dnsyo(
-            listLocation=opts.resolverlist,
-            listLocal=opts.resolverfile,
-            maxWorkers=opts.threads,
-            maxServers=opts.servers,
-            country=opts.country
+            agents=None if opts.agent else opts.agents,
+            agentKey=opts.agentKey,
+            **settings
         )
     except AssertionError as e:
         # Some arguments were not valid, show the error and exit
         p.error(e)
         sys.exit(3)
 
-    if opts.update:
+    if opts.agent:
+        # Run queries for coordinators until we're stopped, each job gets
+        # its own lookup
+        from .remote import serveAgent
+        try:
+            serveAgent(opts.agent, lambda: dnsyo(**settings), opts.agentKey)
+        except KeyboardInterrupt:
+            pass
+        except (ValueError, EnvironmentError) as e:
+            p.error(e)
+            sys.exit(3)
+    elif opts.daemon:
+        # Answer lookups over HTTP until we're stopped
+        from .daemon import serveDaemon
+        try:
+            serveDaemon(opts.daemon, settings)
+        except KeyboardInterrupt:
+            pass
+        except (ValueError, AssertionError, EnvironmentError) as e:
+            p.error(e)
+            sys.exit(3)
+    elif opts.runs or opts.diff:
+        # Look back through the history instead of querying
+        from .history import HistoryStore
+        history = HistoryStore(opts.history)
+        try:
+            if opts.runs:
+                lookup.outputRuns(
+                    history.runs(opts.domain,
+                                 opts.type if opts.domain else None),
+                    simple=opts.simple)
+            else:
+                specs = opts.diff.split(',')
+                old = history.findRun(specs[0], opts.domain, opts.type)
+
+                # Unless told otherwise, compare with the latest run of
+                # the same query
+                new = history.findRun(
+                    specs[1] if len(specs) > 1 else '0s',
+                    opts.domain or old['domain'],
+                    opts.type if opts.domain else old['recordType'])
+
+                lookup.outputDiff(history.diff(old['id'], new['id']),
+                                  simple=opts.simple, extended=opts.extended)
+        except ValueError as e:
+            p.error(e)
+            sys.exit(3)
+        finally:
+            history.close()
+    elif opts.update:
         # Do a list update
         if not opts.updateSummary or not opts.updateDestination:
             p.error("Must supply updateSummary and updateDestination!")
             sys.exit(3)
 
-        u = updater.update(lookup, opts.updateSummary, opts.updateDestination)
+        from .updater import update
+        u = update(lookup, opts.updateSummary, opts.updateDestination)
     else:
         # Do a lookup
 
@@ -163,21 +324,120 @@ def run():
         lookup.prepareList()
 
         try:
-            # Query the servers, display progress if not simple output
-            lookup.query(
-                domain=opts.domain,
-                recordType=opts.type,
-                progress=not opts.simple
-            )
-        except ValueError as e:
+            if opts.batch:
+                queries = readBatch(opts.batch, opts.type)
+
+                if opts.json:
+                    for result in lookup.queryBatchIter(queries, store=False):
+                        with lookup.stats.phase('output'):
+                            lookup.outputJSON(result)
+                else:
+                    lookup.queryBatch(queries, progress=not opts.simple)
+            elif watch:
+                # Print what changed each round until it's propagated
+                for watchRound in lookup.watch(
+                    domain=opts.domain,
+                    recordType=opts.type,
+                    interval=watch,
+                    target=target
+                ):
+                    lookup.outputWatch(watchRound, simple=opts.simple)
+
+                if not opts.simple:
+                    sys.stdout.write("\n")
+            elif opts.stream or opts.json:
+                # Write each result out as it arrives
+                for result in lookup.queryIter(
+                    domain=opts.domain,
+                    recordType=opts.type,
+                    store=False,
+                    agreement=agreement,
+                    minSamples=minSamples,
+                    confidence=confidence
+                ):
+                    with lookup.stats.phase('output'):
+                        if opts.json:
+                            lookup.outputJSON(result)
+                        else:
+                            lookup.outputSimpleStream(result)
+            else:
+                # Query the servers, display progress if not simple output
+                lookup.query(
+                    domain=opts.domain,
+                    recordType=opts.type,
+                    progress=not opts.simple,
+                    agreement=agreement,
+                    minSamples=minSamples,
+                    confidence=confidence
+                )
+        except (ValueError, AssertionError, EnvironmentError) as e:
             p.error(e)
             sys.exit(3)
 
         # Output the relevant result format
-        if opts.simple:
-            lookup.outputSimple()
-        else:
-            lookup.outputStandard(opts.extended)
+        with lookup.stats.phase('output'):
+            if opts.json:
+                pass
+            elif opts.batch:
+                for query in lookup.batch:
+                    if opts.simple:
+                        sys.stdout.write("QUERY {0} {1}\n".format(
+                            query.domain, query.recordType))
+                        query.outputSimple()
+                    else:
+                        query.outputStandard(opts.extended)
+            elif opts.stream:
+                lookup.outputSimple(results=False)
+            elif opts.simple:
+                lookup.outputSimple()
+            else:
+                lookup.outputStandard(opts.extended)
+
+        # Write out how long everything took
+        if opts.stats:
+            if opts.stats == '-':
+                json.dump(lookup.stats.asDict(servers=True), sys.stdout,
+                          indent=2, sort_keys=True)
+                sys.stdout.write("\n")
+            else:
+                lookup.stats.writeJSON(opts.stats)
+
+        if opts.prometheus:
+            lookup.stats.writePrometheus(opts.prometheus)
+
+
+def readBatch(source, defaultType='A'):
+    """
+    Read the queries for a batch run
+
+    Each line is a domain and, optionally, a record type. Blank lines and
+    lines starting with # are skipped.
+
+    @param  source:         File to read, or - for stdin
+    @param  defaultType:    Record type for lines that don't have one
+
+    @return:                (domain, record type) pairs
+    @rtype:                 list
+    """
+
+    if source == '-':
+        lines = sys.stdin.readlines()
+    else:
+        with open(source) as f:
+            lines = f.readlines()
+
+    queries = []
+    for line in lines:
+        parts = line.split('#')[0].split()
+        if not parts:
+            continue
+
+        queries.append((
+            parts[0],
+            parts[1] if len(parts) > 1 else defaultType
+        ))
+
+    return queries
 
 if __name__ == '__main__':
     run()
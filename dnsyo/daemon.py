@@ -0,0 +1,396 @@
+"""
+Answer lookups over HTTP from a long running process
+
+The MIT License (MIT)
+
+Copyright (c) 2013 Sam Rudge (sam@codesam.co.uk)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from .dnsyo import lookup
+from .engine import QueryEngine
+from .remote import parseAddress
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+
+
+# Request parameters that are passed straight on to the lookup
+lookupParameters = {
+    'country': 'country',
+    'provider': 'providers',
+    'excludeProvider': 'excludeProviders',
+    'excludePrefix': 'excludePrefixes',
+    'family': 'family'
+}
+
+
+def _str(value):
+    """
+    Make strings from a request plain `str`, the lookup checks for them
+    """
+
+    if isinstance(value, list):
+        return [_str(v) for v in value]
+    if isinstance(value, (bool, int, float)) or value is None:
+        return value
+
+    return str(value)
+
+
+def _flag(value):
+    """
+    Read a true/false request parameter
+    """
+
+    if isinstance(value, bool):
+        return value
+
+    return str(value).lower() in ('1', 'true', 'yes')
+
+
+class DaemonHandler(BaseHTTPRequestHandler):
+    """
+    Handle a request to the daemon
+
+    `GET` takes its parameters from the query string, `POST` from a JSON
+    object in the body.
+    """
+
+    server_version = 'dnsyo'
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = dict(
+            (k, v[-1]) for k, v in parse_qs(url.query).items())
+
+        self.route(url.path, params)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            params = json.loads(self.rfile.read(length).decode('utf-8') or
+                                '{}')
+            assert isinstance(params, dict)
+        except (ValueError, AssertionError):
+            self.sendJSON(400, {'error': 'Body should be a JSON object'})
+            return
+
+        self.route(url.path, params)
+
+    def route(self, path, params):
+        if path == '/lookup':
+            self.lookup(params)
+        elif path == '/status':
+            self.sendJSON(200, self.server.status())
+        else:
+            self.sendJSON(404, {'error': 'Not found'})
+
+    def lookup(self, params):
+        """
+        Run a lookup, either sending the colated results at the end, or
+        with `stream` set, a line of JSON for each server as it responds
+        followed by the colated results
+        """
+
+        params = dict((k, _str(v)) for k, v in params.items())
+
+        try:
+            assert params.get('domain'), "A domain to query is needed"
+            run = self.server.makeLookup(params)
+
+            agreement = params.get('agreement')
+            agreement = float(agreement) if agreement else None
+            minSamples = int(params.get('minSamples', 30))
+            confidence = float(params.get('confidence', 0.95))
+        except (ValueError, AssertionError) as e:
+            self.sendJSON(400, {'error': str(e)})
+            return
+
+        stream = _flag(params.get('stream', False))
+        servers = _flag(params.get('extended', False))
+
+        with self.server.running(run):
+            sent = False
+            results = run.queryIter(
+                domain=params['domain'],
+                recordType=params.get('type', 'A'),
+                store=False,
+                agreement=agreement,
+                minSamples=minSamples,
+                confidence=confidence
+            )
+
+            try:
+                # Get the first result before replying, so a bad query
+                # still gets an error status
+                try:
+                    first = [next(results)]
+                except StopIteration:
+                    first = []
+
+                if not stream:
+                    for result in results:
+                        pass
+                    self.sendJSON(200, run.asDict(servers))
+                    return
+
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/x-ndjson')
+                self.end_headers()
+                sent = True
+
+                for result in first:
+                    self.writeLine(run.resultDict(result))
+                for result in results:
+                    self.writeLine(run.resultDict(result))
+
+                self.writeLine(run.asDict(servers))
+            except (ValueError, AssertionError) as e:
+                self.sendJSON(400, {'error': str(e)})
+            except EnvironmentError as e:
+                if sent:
+                    # Most likely the client went away part way through
+                    logging.debug("Stopped streaming to {0}: {1}".format(
+                        self.client_address[0], e))
+                else:
+                    self.sendJSON(503, {'error': str(e)})
+            finally:
+                results.close()
+
+    def writeLine(self, message):
+        self.wfile.write(json.dumps(message, sort_keys=True).encode('utf-8'))
+        self.wfile.write(b"\n")
+        self.wfile.flush()
+
+    def sendJSON(self, status, message):
+        body = json.dumps(message, sort_keys=True).encode('utf-8')
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("{0} {1}".format(self.client_address[0],
+                                       format % args))
+
+
+class Daemon(ThreadingMixIn, HTTPServer):
+    """
+    Answer lookups over HTTP, keeping everything that's slow to set up
+    between them
+
+    The resolver list stays parsed in memory (see L{dnsyo.lookup}'s
+    loadedLists) and is checked for updates in the background, and every
+    lookup shares one health store, written out every L{saveHealthEvery}
+    seconds rather than after each lookup.
+
+    Lookups run side by side, each in its own thread with its own engine.
+    The in flight limit is shared out evenly between them, and rebalanced
+    as they start and finish, so a big lookup can't starve small ones.
+    Past L{maxRuns} lookups at once, the rest wait their turn.
+
+    @cvar   maxRuns:            Lookups that can run at once
+    @cvar   saveHealthEvery:    Seconds between writes of the health store
+    @cvar   updateListEvery:    Seconds between checks for a new list
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    maxRuns = 8
+    saveHealthEvery = 60
+    updateListEvery = 60 * 60
+
+    def __init__(self, address, settings):
+        """
+        @param  address:    (host, port) to listen on
+        @param  settings:   Options for L{dnsyo.lookup}, the defaults for
+                            every request
+        """
+
+        HTTPServer.__init__(self, address, DaemonHandler)
+        self.settings = settings
+
+        self.base = lookup(**settings)
+        self.health = self.base.health
+
+        # Preparing a list replaces a lookup's maxServers with how many it
+        # picked, so keep the limit the daemon was started with
+        self.maxServers = self.base.maxServers
+        if self.health:
+            self.health.saveEvery = self.saveHealthEvery
+
+        self.started = time.time()
+        self.served = 0
+        self.active = []
+        self.lock = threading.Lock()
+        self.runs = threading.BoundedSemaphore(self.maxRuns)
+
+        # Load the list now, rather than on the first request
+        self.base.updateList()
+        self.base.loadList(self.base.listLocal)
+
+        self._updater = threading.Thread(target=self._updateList)
+        self._updater.daemon = True
+        self._updater.start()
+
+    def makeLookup(self, params):
+        """
+        Get a lookup ready to run a request
+
+        @param  params: The request's parameters
+        @type   params: dict
+        @rtype:         L{dnsyo.lookup}
+        """
+
+        options = dict(
+            (lookupParameters[k], v) for k, v in params.items()
+            if k in lookupParameters)
+
+        # Ask for as many servers as the request wants, up to the limit
+        # the daemon was started with
+        maxServers = params.get('servers', self.maxServers)
+        if self.maxServers != 'ALL' and (
+                maxServers == 'ALL' or int(maxServers) > self.maxServers):
+            maxServers = self.maxServers
+        options['maxServers'] = maxServers
+
+        # The health store is shared rather than loaded each time
+        options['healthFile'] = None
+
+        run = lookup(**dict(self.settings, **options))
+        run.health = self.health
+        run.prepareList()
+
+        return run
+
+    @contextmanager
+    def running(self, run):
+        """
+        Count a lookup as running while it's in the block, waiting for a
+        free slot first if there are already L{maxRuns}
+        """
+
+        self.runs.acquire()
+        try:
+            with self.lock:
+                self.active.append(run)
+                self._rebalance()
+
+            try:
+                yield
+            finally:
+                with self.lock:
+                    self.active.remove(run)
+                    self.served += 1
+                    self._rebalance()
+
+                if self.health:
+                    self.health.save()
+        finally:
+            self.runs.release()
+
+    def _rebalance(self):
+        """
+        Share the in flight limit between the running lookups
+        """
+
+        share = max(1, self.base.maxWorkers // max(1, len(self.active)))
+
+        for run in self.active:
+            run.maxWorkers = share
+            if isinstance(run.engine, QueryEngine):
+                run.engine.limit(share)
+
+    def status(self):
+        """
+        How the daemon is getting on
+
+        @rtype: dict
+        """
+
+        with self.lock:
+            running = len(self.active)
+
+        return {
+            'uptime': time.time() - self.started,
+            'running': running,
+            'served': self.served,
+            'servers': len(self.base.loadList(self.base.listLocal)[0])
+        }
+
+    def _updateList(self):
+        while True:
+            time.sleep(self.updateListEvery)
+
+            try:
+                self.base.updateList()
+            except Exception as e:
+                # Keep going with the list we've got
+                logging.warning("Could not update the resolver list: "
+                                "{0}".format(e))
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+
+        if self.health:
+            self.health.save(force=True)
+
+
+def serveDaemon(address, settings):
+    """
+    Run the daemon until it's interrupted
+
+    There's no authentication, anyone who can connect can use it to send
+    DNS queries, so it listens on localhost unless told otherwise.
+
+    @param  address:    `host:port` (or just the port) to listen on
+    @param  settings:   Options for L{dnsyo.lookup}, the defaults for
+                        every request
+
+    @type   address:    str
+    @type   settings:   dict
+    """
+
+    server = Daemon(parseAddress(address), settings)
+
+    logging.info("Listening for lookups on http://{0}:{1}/".format(
+        *server.server_address[:2]))
+
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
@@ -25,18 +25,129 @@ THE SOFTWARE.
 """
 
 import os
-import requests
-import yaml
+import copy
+import marshal
+import heapq
+import math
 import time
 import logging
-import threading
 import random
 import sys
-from datetime import datetime
-import dns.resolver
-import itertools
 import json
-import pkg_resources
+from datetime import datetime
+import dns.exception
+import dns.inet
+from .engine import QueryEngine
+from .shard import ShardedEngine
+from .health import HealthStore
+from .records import Server, answers
+from .stats import RunStats
+from .utils import atomicWrite, lockFile
+
+
+def zScore(confidence):
+    """
+    Two sided Z score for a confidence level, e.g. 1.96 for 0.95
+    """
+
+    # Bisect the normal CDF, it's monotonic so this always converges
+    low, high = 0.0, 10.0
+    for i in range(60):
+        mid = (low + high) / 2
+        if math.erf(mid / math.sqrt(2)) < confidence:
+            low = mid
+        else:
+            high = mid
+
+    return (low + high) / 2
+
+
+def version():
+    """
+    The installed version of DNSYO, or `unknown` if it isn't installed
+
+    importlib.metadata is used where it's available, pkg_resources scans
+    everything installed when it's imported so it's only a fallback
+    """
+
+    try:
+        from importlib import metadata
+    except ImportError:
+        import pkg_resources
+        try:
+            return pkg_resources.get_distribution('dnsyo').version
+        except pkg_resources.DistributionNotFound:
+            return 'unknown'
+
+    try:
+        return metadata.version('dnsyo')
+    except metadata.PackageNotFoundError:
+        return 'unknown'
+
+
+def splitOption(value):
+    """
+    Turn an option that can be a list or a comma separated string into
+    a list
+    """
+
+    if not value:
+        return []
+
+    if isinstance(value, str):
+        value = value.split(',')
+
+    return [v.strip() for v in value if v.strip()]
+
+
+def parsePrefix(prefix):
+    """
+    Parse a CIDR network, e.g. 192.0.2.0/24
+
+    @return:    Packed network address and prefix length
+    @rtype:     tuple
+    """
+
+    if '/' in prefix:
+        address, length = prefix.split('/', 1)
+    else:
+        address, length = prefix, None
+
+    try:
+        family = dns.inet.af_for_address(address)
+        packed = dns.inet.inet_pton(family, address)
+    except (ValueError, dns.exception.SyntaxError):
+        raise ValueError("{0} is not a valid network".format(prefix))
+
+    try:
+        length = len(packed) * 8 if length is None else int(length)
+    except ValueError:
+        raise ValueError("{0} is not a valid prefix length".format(prefix))
+
+    if not 0 <= length <= len(packed) * 8:
+        raise ValueError("{0} is not a valid prefix length".format(prefix))
+
+    return packed, length
+
+
+def prefixMatch(prefix, address):
+    """
+    Check if a packed address is inside a prefix from L{parsePrefix}
+    """
+
+    network, length = prefix
+    if len(network) != len(address):
+        return False
+
+    fullBytes, bits = divmod(length, 8)
+    if network[:fullBytes] != address[:fullBytes]:
+        return False
+    if bits == 0:
+        return True
+
+    mask = (0xff << (8 - bits)) & 0xff
+    return (bytearray(network)[fullBytes] & mask) == \
+        (bytearray(address)[fullBytes] & mask)
 
 
 class lookup(object):
@@ -49,9 +160,37 @@ class lookup(object):
     @cvar   lookupRecordTypes:      Types of X{DNS records} supported,
                                     feel free to add more
     @cvar   updateListEvery:        How often to update the X{resolver list}
+    @cvar   metaSuffix:             Added to the list location to get the
+                                    location of its HTTP validators
+    @cvar   lockSuffix:             Added to the list location to get the
+                                    location of its update lock
+    @cvar   cacheSuffix:            Added to the list location to get the
+                                    location of its cache
+    @cvar   cacheVersion:           Version of the cache format
+    @cvar   loadedLists:            Lists (and their indexes) already
+                                    loaded by this process
     @cvar   serverList:             Resolvers to query
     @cvar   results:                Store the results from each server
     @cvar   resultsColated:         The processed results
+    @cvar   colationIndex:          Position of each answer set in
+                                    resultsColated, by its
+                                    L{dnsyo.records.Answer}
+    @cvar   topColated:             The most common result in
+                                    resultsColated
+    @cvar   partial:                True if the run stopped before every
+                                    server responded
+    @cvar   consensus:              If the run stopped early because the
+                                    servers `agreed` or `disagreed`
+    @cvar   batch:                  A L{lookup} holding the results of
+                                    each query in a batch
+    @cvar   batchIndex:             The batch lookups by (domain, type)
+    @cvar   engine:                 The L{QueryEngine} of the current run
+    @cvar   stats:                  L{RunStats} of how long each part of
+                                    the run took
+    @cvar   minShardSize:           Fewest servers worth starting another
+                                    process for
+    @cvar   history:                L{HistoryStore} runs are saved to,
+                                    opened on the first save
     """
 
     lookupRecordTypes = ['A',
@@ -68,10 +207,36 @@ class lookup(object):
     # Update the resolver list every 14 days
     updateListEvery = 60 * 60 * 24 * 14
 
+    # Validators for conditional downloads of the list, and the lock held
+    # while it's being updated
+    metaSuffix = '.meta'
+    lockSuffix = '.lock'
+
+    # Pre-parsed resolver list, bump the version if the format changes
+    cacheSuffix = '.cache'
+    cacheVersion = 4
+
+    # Lists already loaded in this process, by location
+    loadedLists = {}
+
     serverList = []
 
     results = []
     resultsColated = []
+    colationIndex = {}
+    topColated = None
+    _queried = 0
+    _successful = 0
+    partial = False
+    consensus = None
+
+    batch = []
+    batchIndex = {}
+
+    engine = None
+    stats = None
+    minShardSize = 100
+    history = None
 
     def __init__(self,
                  listLocation,
@@ -79,7 +244,17 @@ class lookup(object):
                  expected=None,
                  maxServers='ALL',
                  maxWorkers=50,
-                 country=None
+                 country=None,
+                 providers=None,
+                 excludeProviders=None,
+                 excludePrefixes=None,
+                 family=None,
+                 healthFile=None,
+                 maxRate=None,
+                 processes=1,
+                 agents=None,
+                 agentKey=None,
+                 historyFile=None
                  ):
         """
         Get everything setup and ready to go
@@ -91,14 +266,50 @@ class lookup(object):
         @param  listLocation:   HTTP address of the X{resolver list}
         @param  listLocal:      Local file where X{resolver list} should
                                 be stored
-        @param  expected:       Not used yet
+        @param  expected:       The answer we're waiting for servers to
+                                give, see L{watch}
         @param  maxServers:     Limit number of servers to query
-        @param  maxWorkers:     Maximum number of threads
+        @param  maxWorkers:     Maximum number of queries in flight, the
+                                engine works up to this as long as
+                                packets aren't being lost
+        @param  country:        Only query servers in these countries
+        @param  providers:      Only query servers from these providers
+                                (full name or AS name)
+        @param  excludeProviders:   Don't query servers from these
+                                    providers
+        @param  excludePrefixes:    Don't query servers in these networks
+        @param  family:         Only query IPv4 or IPv6 servers
+        @param  healthFile:     Where to keep track of how servers have
+                                responded, to pick better ones next time.
+                                Leave as None to not track them.
+        @param  maxRate:        Maximum packets to send per second, None
+                                for no limit
+        @param  processes:      Split big runs across this many processes
+        @param  agents:         Send the queries from these agents
+                                (`host:port`) instead of from here, see
+                                L{dnsyo.remote}
+        @param  agentKey:       Key the agents were started with
+        @param  historyFile:    SQLite file to save every server's answers
+                                to, see L{dnsyo.history}. Leave as None to
+                                not save them.
 
         @type   listLocation:   str (HTTP address)
         @type   listLocal:      str (File path)
+        @type   expected:       list (or `|` separated str)
         @type   maxServers:     int (or str `ALL`)
         @type   maxWorkers:     int
+        @type   country:        list (or comma separated str)
+        @type   providers:      list (or comma separated str)
+        @type   excludeProviders:   list (or comma separated str)
+        @type   excludePrefixes:    list of CIDR networks (or comma
+                                    separated str)
+        @type   family:         int (4 or 6)
+        @type   healthFile:     str (File path)
+        @type   maxRate:        float
+        @type   processes:      int
+        @type   agents:         list (or comma separated str)
+        @type   agentKey:       str
+        @type   historyFile:    str (File path)
         """
 
         # Ignore list URL validation, requests will just throw a funny
@@ -110,6 +321,21 @@ class lookup(object):
         except ValueError:
             assert False, "Thread count should be a number"
 
+        # Check maxRate
+        if maxRate is not None:
+            try:
+                maxRate = float(maxRate)
+            except ValueError:
+                assert False, "Rate limit should be a number"
+            assert maxRate > 0, "Rate limit should be more than 0"
+
+        # Check processes
+        try:
+            processes = int(processes)
+        except ValueError:
+            assert False, "Process count should be a number"
+        assert processes >= 1, "Process count should be at least 1"
+
         # Check maxServers
         if not maxServers == 'ALL':
             try:
@@ -117,12 +343,49 @@ class lookup(object):
             except ValueError:
                 assert False, "Servers to query should be a number or ALL"
 
+        # Check the address family
+        if family is not None:
+            try:
+                family = int(family)
+            except ValueError:
+                family = None
+            assert family in (4, 6), "Address family should be 4 or 6"
+
+        # Check the prefixes parse
+        excludePrefixes = splitOption(excludePrefixes)
+        if excludePrefixes:
+            try:
+                excludePrefixes = [parsePrefix(p) for p in excludePrefixes]
+            except ValueError as e:
+                assert False, "Invalid prefix to exclude, {0}".format(e)
+
+        # Answers are compared sorted, the same way results are stored
+        if isinstance(expected, str):
+            expected = expected.split('|')
+        if expected is not None:
+            expected = sorted([e.strip() for e in expected if e.strip()])
+            assert expected, "Expected answer should not be empty"
+
         # W00T! Validation completed, save everything to instance
         self.listLocation = listLocation
         self.listLocal = os.path.expanduser(listLocal)
         self.maxWorkers = maxWorkers
         self.maxServers = maxServers
-        self.country = country.upper() if country else None
+        self.expected = expected
+        self.country = [c.upper() for c in splitOption(country)] or None
+        self.providers = [
+            p.lower() for p in splitOption(providers)] or None
+        self.excludeProviders = [
+            p.lower() for p in splitOption(excludeProviders)] or None
+        self.excludePrefixes = excludePrefixes or None
+        self.family = family
+        self.health = HealthStore(healthFile) if healthFile else None
+        self.maxRate = maxRate
+        self.processes = processes
+        self.agents = splitOption(agents) or None
+        self.agentKey = agentKey
+        self.historyFile = historyFile
+        self.stats = RunStats()
 
     def updateList(self):
         """
@@ -130,41 +393,290 @@ class lookup(object):
 
         Get the filemtime on the local list, if it's older than the hosted list
         download the new one
+
+        The download is conditional on the list having changed since we
+        last fetched it, using the validators saved in L{metaSuffix}.
+        Only one process updates the list at a time, any others carry on
+        with the old copy (or wait, if there isn't one yet). The new list
+        is written to a temporary file and moved into place, so it's never
+        read half written.
         """
 
         logging.debug("Checking local and remote resolver list for update")
 
-        # If the local resolver file does not exist, or it has expired
-        if not os.path.isfile(self.listLocal) or \
-                os.path.getmtime(self.listLocal) < \
-                time.time() - self.updateListEvery:
-            logging.info("Updating resolver list file")
-            r = requests.get(
-                self.listLocation,
-                headers={
-                    'User-Agent': "dnsyo/{0}".format(
-                        pkg_resources.get_distribution("dnsyo").version
+        # If the local resolver file exists and hasn't expired
+        if not self.listExpired():
+            return
+
+        haveList = os.path.isfile(self.listLocal)
+
+        lock = lockFile(self.listLocal + self.lockSuffix,
+                        blocking=not haveList)
+        if lock is None:
+            logging.info("Resolver list is being updated by another "
+                         "process, using the current one")
+            return
+
+        try:
+            # It might have been updated while we waited for the lock
+            if not self.listExpired():
+                return
+
+            with self.stats.phase('listRefresh'):
+                self.downloadList()
+        finally:
+            lock.close()
+
+    def listExpired(self):
+        """
+        Check if the local X{resolver list} is missing or out of date
+
+        @rtype: bool
+        """
+
+        return not os.path.isfile(self.listLocal) or \
+            os.path.getmtime(self.listLocal) < \
+            time.time() - self.updateListEvery
+
+    def downloadList(self):
+        """
+        Download the X{resolver list}, if it's changed
+
+        Call L{updateList} rather than using this directly
+        """
+
+        logging.info("Updating resolver list file")
+
+        metaFile = self.listLocal + self.metaSuffix
+        haveList = os.path.isfile(self.listLocal)
+
+        # Only needed when the list is out of date, and slow to import
+        import requests
+
+        headers = {
+            'User-Agent': "dnsyo/{0}".format(version()),
+            'Accept-Encoding': 'gzip, deflate'
+        }
+
+        # Ask the server to only send the list if it's changed
+        meta = {}
+        if haveList and os.path.isfile(metaFile):
+            try:
+                with open(metaFile) as mf:
+                    meta = json.load(mf)
+            except ValueError:
+                meta = {}
+
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('lastModified'):
+                headers['If-Modified-Since'] = meta['lastModified']
+
+        r = requests.get(self.listLocation, headers=headers)
+
+        if r.status_code == 304 and haveList:
+            # Our copy is current, reset the clock on it
+            logging.debug("Resolver list has not changed")
+            os.utime(self.listLocal, None)
+        elif r.status_code != 200:
+            # If status code response is not 200 and we don't
+            # already have a resolvers file, raise an exception
+            # Otherwise keep going with the old file
+            if not haveList:
+                # File does not exist locally, we can't continue
+                raise EnvironmentError(
+                    "List location returned HTTP status {0} and we "
+                    "don't have a local copy of resolvers to fall "
+                    "back on. Can't continue".format(
+                        r.status_code
                     )
-                }
+                )
+        else:
+            # Save the file, and how to check if it's changed next time.
+            # Anyone who can read the list can read what goes with it
+            atomicWrite(self.listLocal, r.text)
+            atomicWrite(metaFile, json.dumps({
+                'etag': r.headers.get('ETag'),
+                'lastModified': r.headers.get('Last-Modified')
+            }), like=self.listLocal)
+
+    def loadList(self, listFile, cache=True):
+        """
+        Load a X{resolver list} file
+
+        Parsing the yaml is slow for big lists, so a pre-parsed copy is
+        kept next to it in L{cacheSuffix}, and used as long as the list's
+        mtime and size haven't changed since it was written. The servers
+        are kept in it as rows of fields, and loaded as L{Server} records.
+
+        @param  listFile:   Location of the yaml list
+        @param  cache:      Read and write the cache file
+
+        @type   listFile:   str (File path)
+        @type   cache:      bool
+
+        @return:            The servers in the list as L{Server}
+                            records, and the index built by L{indexList}
+        @rtype:             tuple
+        """
+
+        stat = os.stat(listFile)
+        cacheKey = (self.cacheVersion, stat.st_mtime, stat.st_size)
+        cacheFile = listFile + self.cacheSuffix
+
+        # Already loaded by this process
+        loaded = self.loadedLists.get(os.path.abspath(listFile))
+        if loaded and loaded[0] == cacheKey:
+            return loaded[1], loaded[2]
+
+        cached = None
+        if cache and os.path.isfile(cacheFile):
+            try:
+                with open(cacheFile, 'rb') as cf:
+                    cached = marshal.load(cf)
+
+                if cached[0] == cacheKey:
+                    logging.debug("Loaded resolver list from cache")
+                else:
+                    cached = None
+            except (EOFError, ValueError, TypeError, IndexError) as e:
+                logging.debug("Resolver list cache is invalid: {0}".format(e))
+                cached = None
+
+        if cached is None:
+            # Only needed when the cache is out of date, and slow to import
+            import yaml
+
+            # Use the C yaml parser if it's available, it's much faster
+            try:
+                from yaml import CSafeLoader as SafeLoader
+            except ImportError:
+                from yaml import SafeLoader
+
+            # Open and yaml parse the resolver list
+            with open(listFile) as ll:
+                raw = ll.read()
+                # Use the safe loader, just to be safe.
+                serverList = yaml.load(raw, Loader=SafeLoader)
+
+            cached = (
+                cacheKey,
+                [Server.fromDict(s).row() for s in serverList],
+                self.indexList(serverList)
             )
 
-            if r.status_code != 200:
-                # If status code response is not 200 and we don't
-                # already have a resolvers file, raise an exception
-                # Otherwise keep going with the old file
-                if not os.path.isfile(self.listLocal):
-                    # File does not exist locally, we can't continue
-                    raise EnvironmentError(
-                        "List location returned HTTP status {0} and we "
-                        "don't have a local copy of resolvers to fall "
-                        "back on. Can't continue".format(
-                            r.status_code
-                        )
-                    )
+            if cache:
+                try:
+                    atomicWrite(cacheFile, marshal.dumps(cached), 'wb',
+                                like=listFile)
+                except EnvironmentError as e:
+                    # Not a problem, we'll just parse it again next time
+                    logging.debug("Could not write resolver list cache: "
+                                  "{0}".format(e))
+
+        loaded = (cached[0], [Server(*row) for row in cached[1]], cached[2])
+        self.loadedLists[os.path.abspath(listFile)] = loaded
+
+        return loaded[1], loaded[2]
+
+    def indexList(self, serverList):
+        """
+        Index a X{resolver list} so it can be filtered without going
+        through every server
+
+        Each index maps a value to the set of positions in the list with
+        that value. Providers are indexed by their full name and by their
+        AS name, both lower case. The AS name is the part before ` - `, or
+        for lists that don't use that (`AAPT AAPT Limited,AU`) the first
+        word.
+
+        @param  serverList: The servers to index
+        @type   serverList: list
+
+        @return:            Dict of indexes, `country`, `provider` and
+                            `family`, plus `address`, the packed address
+                            of each server
+        @rtype:             dict
+        """
+
+        index = {
+            'country': {},
+            'provider': {},
+            'family': {},
+            'address': []
+        }
+
+        for i, s in enumerate(serverList):
+            index['country'].setdefault(s['country'], set()).add(i)
+
+            provider = s['provider'].lower()
+            index['provider'].setdefault(provider, set()).add(i)
+            if ' - ' in provider:
+                asName = provider.split(' - ')[0]
             else:
-                # Save the file
-                with open(self.listLocal, 'w') as lf:
-                    lf.write(r.text)
+                asName = (provider.split() or [provider])[0]
+            if asName != provider:
+                index['provider'].setdefault(asName, set()).add(i)
+
+            try:
+                family = dns.inet.af_for_address(s['ip'])
+                address = dns.inet.inet_pton(family, s['ip'])
+            except ValueError:
+                family, address = None, b''
+            family = 6 if family == dns.inet.AF_INET6 else 4
+
+            index['family'].setdefault(family, set()).add(i)
+            index['address'].append(address)
+
+        return index
+
+    def filterList(self, serverList, index):
+        """
+        Get the servers that match our filters
+
+        @param  serverList: The servers to filter
+        @param  index:      Index of serverList from L{indexList}
+
+        @return:            The matching servers
+        @rtype:             list
+        """
+
+        def union(idx, keys):
+            matched = set()
+            for key in keys:
+                matched |= idx.get(key, set())
+            return matched
+
+        if not (self.country or self.providers or self.excludeProviders or
+                self.excludePrefixes or self.family):
+            return serverList
+
+        logging.debug("Filtering serverList")
+
+        matched = set(range(len(serverList)))
+
+        if self.country:
+            matched &= union(index['country'], self.country)
+
+        if self.providers:
+            matched &= union(index['provider'], self.providers)
+
+        if self.excludeProviders:
+            matched -= union(index['provider'], self.excludeProviders)
+
+        if self.family:
+            matched &= index['family'].get(self.family, set())
+
+        if self.excludePrefixes:
+            matched = set([
+                i for i in matched
+                if not any([
+                    prefixMatch(prefix, index['address'][i])
+                    for prefix in self.excludePrefixes
+                ])
+            ])
+
+        return [serverList[i] for i in sorted(matched)]
 
     def prepareList(self, listFile=False, noSample=False):
         """
@@ -184,24 +696,26 @@ class lookup(object):
         assert os.access(os.path.dirname(listLocal), os.W_OK),\
             "{0} is not writable!".format(os.path.dirname(listLocal))
 
-        # Open and yaml parse the resolver list
-        with open(listLocal) as ll:
-            raw = ll.read()
-            # Use safe_load, just to be safe.
-            serverList = yaml.safe_load(raw)
-
-        # Remove all but the specified countries from the server list
-        if self.country is not None:
-            logging.debug("Filtering serverList for country {0}"
-                          .format(self.country))
+        # Only the downloaded list gets a cache, we don't want to litter
+        # cache files next to lists passed in from elsewhere
+        with self.stats.phase('listLoad'):
+            serverList, index = self.loadList(
+                listLocal,
+                cache=os.path.abspath(listLocal) ==
+                os.path.abspath(self.listLocal)
+            )
 
-            serverList = [d for d in serverList
-                          if d['country'] == self.country]
+        # Remove all but the servers we're interested in
+        with self.stats.phase('filter'):
+            serverList = self.filterList(serverList, index)
 
-            if len(serverList) == 0:
+        if len(serverList) == 0:
+            if self.country:
                 raise ValueError("There are no servers avaliable "
                                  "with the country code {0}"
-                                 .format(self.country))
+                                 .format(",".join(self.country)))
+            raise ValueError("There are no servers avaliable "
+                             "that match the filters")
 
         # Get selected number of servers
         if self.maxServers == 'ALL' or noSample:
@@ -222,22 +736,516 @@ class lookup(object):
 
         # Get a random selection of the specified number
         # of servers from the list
-        self.serverList = random.sample(serverList, self.maxServers)
+        with self.stats.phase('sampling'):
+            if self.health is None or noSample:
+                self.serverList = random.sample(serverList, self.maxServers)
+            else:
+                self.serverList = self.sampleHealthy(
+                    serverList, self.maxServers)
 
         return self.serverList
 
-    def query(self, domain, recordType, progress=True):
+    def sampleHealthy(self, serverList, count):
+        """
+        Get a random selection of servers, favouring the ones that have
+        responded well in the past
+
+        Servers the L{HealthStore} thinks are dead are skipped, unless
+        we'd run out of servers without them
+
+        @param  serverList: Servers to pick from
+        @param  count:      Number of servers to pick
+
+        @rtype:             list
+        """
+
+        alive = [s for s in serverList if not self.health.isDead(s['ip'])]
+        if len(alive) >= count:
+            logging.debug("Skipping {0} dead servers".format(
+                len(serverList) - len(alive)))
+            serverList = alive
+
+        # Weighted sampling without replacement, each server gets a random
+        # key skewed by its weight and we take the highest keys
+        def key(server):
+            return random.random() ** (1.0 / self.health.weight(server['ip']))
+
+        return heapq.nlargest(count, serverList, key=key)
+
+    def query(self, domain, recordType, progress=True, agreement=None,
+              minSamples=30, confidence=0.95):
         """
         Run the query
 
-        Query spins out multiple thread workers to query each server
+        Query sends the queries to each server from a L{QueryEngine},
+        up to maxWorkers at once, and waits for them all to finish (or
+        until the agreement rule is met, see L{queryIter})
 
         @param  domain:     Domain to query
         @param  recordType: Type of record to query for
         @param  progress:   Write progress to stdout
+        @param  agreement:  Stop once we're confident whether or not this
+                            fraction of servers agree
+        @param  minSamples: Responses needed before stopping early
+        @param  confidence: How confident to be before stopping early
+
+        @type   domain:         str
+        @type   recordType:     str
+        @type   agreement:      float (0 - 1)
+        @type   minSamples:     int
+        @type   confidence:     float (0 - 1)
+        """
+
+        startTime = datetime.utcnow()
+        lastProgress = None
+        queried = 0
+
+        for result in self.queryIter(
+            domain,
+            recordType,
+            agreement=agreement,
+            minSamples=minSamples,
+            confidence=confidence
+        ):
+            queried += 1
+
+            # Output progress, but don't redraw more than 10 times a second
+            if progress and (
+                lastProgress is None or
+                time.time() - lastProgress >= 0.1
+            ):
+                lastProgress = time.time()
+                self._progress(queried, startTime)
+
+        if progress:
+            # Make sure the final count is shown
+            self._progress(queried, startTime)
+            sys.stdout.write("\n\n")
+
+        logging.debug("There are {0} unique results".format(
+            len(self.resultsColated)))
+
+    def _progress(self, queried, startTime):
+        """
+        Output progress on one line that updates if terminal supports it
+        """
+
+        sys.stdout.write(
+            "\r\x1b[KStatus: Queried {0} of {1} servers, "
+            "duration: {2}".format(
+                queried, len(self.serverList),
+                (datetime.utcnow() - startTime))
+        )
+        # Make sure the stdout updates
+        sys.stdout.flush()
+
+    def queryIter(self, domain, recordType, store=True, agreement=None,
+                  minSamples=30, confidence=0.95):
+        """
+        Run the query, yielding each server's result as soon as it's ready
+
+        resultsColated is kept up to date as results come in, so it can
+        be read at any point during the run
+
+        If agreement is set, the run stops as soon as the most common
+        answer's share of the responses is confidently above (or below)
+        that fraction. Outstanding queries are abandoned, L{partial} is
+        set and L{consensus} says which way it went.
+
+        @param  domain:     Domain to query
+        @param  recordType: Type of record to query for
+        @param  store:      Keep every result in L{results}, turn off to
+                            keep memory use flat on large runs
+        @param  agreement:  Stop once we're confident whether or not this
+                            fraction of servers agree
+        @param  minSamples: Responses needed before stopping early
+        @param  confidence: How confident to be before stopping early
+
+        @type   domain:         str
+        @type   recordType:     str
+        @type   store:          bool
+        @type   agreement:      float (0 - 1)
+        @type   minSamples:     int
+        @type   confidence:     float (0 - 1)
+
+        @return:            Generator of results
+        """
+
+        if agreement is not None:
+            assert 0 < agreement <= 1, "Agreement should be between 0 and 1"
+            assert 0 < confidence < 1, \
+                "Confidence should be between 0 and 1"
+            z = zScore(confidence)
+
+        recordType = self._checkQuery(domain, recordType)
+        self._reset(domain, recordType)
+        self._checkServerList()
+
+        logging.debug("Starting query against {0} servers".format(
+            len(self.serverList)))
+
+        # Queries all go out from one engine, no threads needed
+        self.engine = self._engine(len(self.serverList))
+
+        # Results come back as each server finishes
+        results = self._run([(domain, recordType)])
+        for result in results:
+            if store:
+                self.results.append(result)
+            self.colate(result)
+
+            yield result
+
+            if agreement is not None and self.queriedCount() >= minSamples:
+                self.consensus = self.checkConsensus(agreement, z)
+                if self.consensus is not None:
+                    logging.debug("Stopping early, servers {0}".format(
+                        self.consensus))
+                    self.partial = \
+                        self.queriedCount() < len(self.serverList)
+                    results.close()
+                    return
+
+    def checkConsensus(self, agreement, z):
+        """
+        Check if the servers that have responded so far tell us whether
+        the given fraction of all servers agree on an answer
+
+        Uses the Wilson score interval for the most common answer's share
+        of the responses.
+
+        @param  agreement:  Fraction of servers to check for
+        @param  z:          Z score for the confidence level wanted
+
+        @return:            `agreed`, `disagreed` or None if we can't be
+                            sure yet
+        """
+
+        n = float(self.queriedCount())
+        if n == 0 or self.topColated is None:
+            return None
+
+        p = len(self.topColated['servers']) / n
+        centre = p + z * z / (2 * n)
+        spread = z * math.sqrt(p * (1 - p) / n + z * z / (4 * n * n))
+        scale = 1 + z * z / n
+
+        if (centre - spread) / scale >= agreement:
+            return 'agreed'
+        elif (centre + spread) / scale < agreement:
+            return 'disagreed'
+
+        return None
+
+    def queryBatch(self, queries, progress=True):
+        """
+        Run several queries against the same servers at once
+
+        All the queries share one engine, so maxWorkers limits the total
+        number of queries in flight across the whole batch
+
+        @param  queries:    (domain, record type) pairs to query
+        @param  progress:   Write progress to stdout
+
+        @type   queries:    list
+
+        @return:            A L{lookup} for each (distinct) query, in order,
+                            with its own results and resultsColated
+        @rtype:             list
+        """
+
+        startTime = datetime.utcnow()
+        lastProgress = None
+        queried = 0
+
+        for result in self.queryBatchIter(queries):
+            queried += 1
+
+            # Output progress, but don't redraw more than 10 times a second
+            total = len(self.serverList) * len(self.batch)
+            if progress and (
+                lastProgress is None or
+                time.time() - lastProgress >= 0.1 or
+                queried == total
+            ):
+                lastProgress = time.time()
+
+                sys.stdout.write(
+                    "\r\x1b[KStatus: Finished {0} of {1} queries to {2} "
+                    "servers, duration: {3}".format(
+                        queried, total, len(self.serverList),
+                        (datetime.utcnow() - startTime))
+                )
+                sys.stdout.flush()
+
+        if progress:
+            sys.stdout.write("\n\n")
+
+        return self.batch
+
+    def queryBatchIter(self, queries, store=True):
+        """
+        Run several queries against the same servers at once, yielding
+        each result as soon as it's ready
+
+        Results for each query are colated into their own L{lookup},
+        listed in L{batch} and indexed by (domain, record type) in
+        L{batchIndex}, so the usual output methods work on each of them.
+
+        @param  queries:    (domain, record type) pairs to query
+        @param  store:      Keep every result in each query's results
+
+        @type   queries:    list
+        @type   store:      bool
+
+        @return:            Generator of results
+        """
+
+        self.batch = []
+        self.batchIndex = {}
+
+        for domain, recordType in queries:
+            recordType = self._checkQuery(domain, recordType)
+
+            # Asking the same thing twice won't tell us anything new
+            if (domain, recordType) in self.batchIndex:
+                continue
+
+            child = copy.copy(self)
+            child._reset(domain, recordType)
+            child.batch, child.batchIndex = [], {}
+            self.batch.append(child)
+            self.batchIndex[(domain, recordType)] = child
+
+        self._checkServerList()
+
+        logging.debug("Starting {0} queries against {1} servers".format(
+            len(self.batch), len(self.serverList)))
+
+        self.engine = self._engine(len(self.serverList))
+
+        for result in self._run(
+            [(child.domain, child.recordType) for child in self.batch]
+        ):
+            child = self.batchIndex[(result['domain'], result['recordType'])]
+            if store:
+                child.results.append(result)
+            child.colate(result)
+
+            yield result
+
+    def watch(self, domain, recordType, interval=30, expected=None,
+              target=1.0, store=True):
+        """
+        Keep querying until enough servers give the expected answer
+
+        The first round asks every server. After that, each round only
+        asks the servers whose last answer wasn't the expected one, and
+        only once the answer they gave has expired from their cache (errors
+        and timeouts are asked again straight away). So as a change
+        propagates, fewer servers are asked each round.
+
+        resultsColated always holds every server's latest answer, so the
+        usual output methods work between rounds.
+
+        @param  domain:     Domain to query
+        @param  recordType: Type of record to query for
+        @param  interval:   Seconds between the start of each round
+        @param  expected:   The answer to wait for, defaults to the one
+                            given when setting up the lookup
+        @param  target:     Stop once this fraction of servers give the
+                            expected answer
+        @param  store:      Keep each server's latest result in L{results}
 
         @type   domain:         str
         @type   recordType:     str
+        @type   interval:       float
+        @type   expected:       list (or `|` separated str)
+        @type   target:         float (0 - 1)
+        @type   store:          bool
+
+        @return:            Generator of dicts for each round, with the
+                            `round` number, how many servers were
+                            `queried`, how many have `propagated` out of
+                            the `total`, and the `changes` since the last
+                            round as (count, old answer, new answer) where
+                            answers are (success, results) and the old
+                            answer is None in the first round
+        """
+
+        if expected is None:
+            expected = self.expected
+        elif isinstance(expected, str):
+            expected = expected.split('|')
+        assert expected, "Need an expected answer to watch for"
+        expected = answers.intern(True, sorted(
+            [e.strip() for e in expected if e.strip()]))
+
+        assert interval > 0, "Watch interval should be more than 0"
+        assert 0 < target <= 1, "Target should be between 0 and 1"
+
+        recordType = self._checkQuery(domain, recordType)
+        self._reset(domain, recordType)
+        self._checkServerList()
+
+        latest = {}
+        expires = {}
+        servers = self.serverList
+        roundNumber = 0
+
+        while True:
+            roundNumber += 1
+            roundStart = time.time()
+
+            logging.debug("Watch round {0}, querying {1} servers".format(
+                roundNumber, len(servers)))
+
+            self.engine = self._engine(len(servers))
+
+            changes = {}
+            for result in self._run([(domain, recordType)], servers):
+                ip = result['server']['ip']
+                key = result['answer']
+
+                old = latest.get(ip)
+                old = old['answer'] if old is not None else None
+                if old != key:
+                    changes[(old, key)] = changes.get((old, key), 0) + 1
+
+                latest[ip] = result
+                expires[ip] = time.time() + (result.get('ttl') or 0)
+
+            # Rebuild the colation from everyone's latest answer
+            self.resultsColated = []
+            self.colationIndex = {}
+            self.topColated = None
+            self._queried = 0
+            self._successful = 0
+            self.results = []
+            for server in self.serverList:
+                result = latest[server['ip']]
+                if store:
+                    self.results.append(result)
+                self.colate(result)
+
+            cid = self.colationIndex.get(expected)
+            propagated = len(self.resultsColated[cid]['servers']) \
+                if cid is not None else 0
+
+            yield {
+                'round': roundNumber,
+                'queried': len(servers),
+                'propagated': propagated,
+                'total': len(self.serverList),
+                'changes': sorted(
+                    [(count, tuple(old) if old is not None else None,
+                      tuple(new))
+                     for (old, new), count in changes.items()],
+                    key=lambda c: -c[0])
+            }
+
+            if propagated >= target * len(self.serverList):
+                return
+
+            # Wait for the next round that has servers worth asking
+            servers = []
+            while not servers:
+                roundStart += interval
+                time.sleep(max(0, roundStart - time.time()))
+
+                servers = [
+                    s for s in self.serverList
+                    if expires[s['ip']] <= roundStart and
+                    latest[s['ip']]['answer'] != expected
+                ]
+
+    def _engine(self, serverCount):
+        """
+        Create the engine for a run, split across agents if there are
+        any, or processes if it's big enough to be worth it
+        """
+
+        if self.agents:
+            from .remote import RemoteEngine
+            return RemoteEngine(
+                self.agents,
+                maxInFlight=self.maxWorkers,
+                maxRate=self.maxRate,
+                key=self.agentKey
+            )
+
+        if self.processes > 1 and \
+                serverCount >= self.processes * self.minShardSize:
+            return ShardedEngine(
+                self.processes,
+                maxInFlight=self.maxWorkers,
+                health=self.health,
+                maxRate=self.maxRate
+            )
+
+        return QueryEngine(
+            maxInFlight=self.maxWorkers,
+            health=self.health,
+            maxRate=self.maxRate,
+            stats=self.stats
+        )
+
+    def _run(self, queries, servers=None):
+        """
+        Send the queries to every server (or just the ones given),
+        updating the health store with each result, and saving them all
+        to the history if there is one
+
+        Results from agents aren't recorded in the health store, their
+        response times and failures are from somewhere else
+        """
+
+        if servers is None:
+            servers = self.serverList
+
+        history = {}
+        recordHealth = self.health and not self.agents
+
+        start = time.time()
+        try:
+            for result in self.engine.run(servers, queries):
+                self.stats.observe(result)
+                if recordHealth:
+                    self.health.record(result)
+                if self.historyFile:
+                    history.setdefault(
+                        (result['domain'], result['recordType']), []
+                    ).append(result)
+
+                yield result
+        finally:
+            self.stats.add('query', time.time() - start)
+
+            if recordHealth:
+                with self.stats.phase('healthSave'):
+                    self.health.save()
+
+            if history:
+                with self.stats.phase('historySave'):
+                    self._saveHistory(history, start, len(servers))
+
+    def _saveHistory(self, runs, started, servers):
+        """
+        Save each query's results as a run in the history
+        """
+
+        if self.history is None:
+            from .history import HistoryStore
+            self.history = HistoryStore(self.historyFile)
+
+        for (domain, recordType), results in runs.items():
+            self.history.save(domain, recordType, results, started, servers)
+
+    def _checkQuery(self, domain, recordType):
+        """
+        Validate a query
+
+        @return:    The normalised record type
         """
 
         # Ignore domain validation, if someone wants to lookup an invalid
@@ -250,128 +1258,115 @@ class lookup(object):
             "Record type is not in valid list of record types {0}". \
             format(', '.join(self.lookupRecordTypes))
 
+        return recordType
+
+    def _reset(self, domain, recordType):
+        """
+        Clear out the results ready for a new query
+        """
+
         self.domain = domain
         self.recordType = recordType
         self.resultsColated = []
+        self.colationIndex = {}
+        self.topColated = None
+        self._queried = 0
+        self._successful = 0
         self.results = []
+        self.partial = False
+        self.consensus = None
+
+    def _checkServerList(self):
+        """
+        Make sure we have some servers to query
+        """
 
         if len(self.serverList) == 0:
             logging.warning("Server list is empty. Attempting "
                             "to populate with prepareList")
             self.prepareList()
 
-        logging.debug("Starting query against {0} servers".format(
-            len(self.serverList)))
+    def colate(self, result):
+        """
+        Add a single result to the colated results
 
-        workers = []
-        startTime = datetime.utcnow()
-        serverCounter = 0
-
-        # Run continuously while waiting for results
-        while len(self.results) < len(self.serverList):
-
-            # Count the workers still running
-            runningWorkers = len([w for w in workers if w.result is None])
-
-            # Get the results of any finished workers
-            for i, w in enumerate(workers):
-                if w.result:
-                    # Add the results and get rid of the worker from the
-                    # worker list
-                    self.results.append(w.result)
-                    workers.pop(i)
-
-            # Output progress
-            if progress:
-                # Output progress on one line that updates if terminal
-                # supports it
-                sys.stdout.write(
-                    "\r\x1b[KStatus: Queried {0} of {1} servers, duration: {2}"
-                    .format(len(self.results), len(self.serverList),
-                            (datetime.utcnow() - startTime))
-                )
-                # Make sure the stdout updates
-                sys.stdout.flush()
+        Results are grouped by the servers that gave the same response,
+        the index means this doesn't need to search resultsColated so it's
+        cheap to do as each result comes in
 
-            # Start more workers if needed
-            if runningWorkers < self.maxWorkers:
-                logging.debug("Starting {0} workers".format(
-                    self.maxWorkers - runningWorkers))
-
-                # Start however many workers we need
-                # based on max workers - running workers
-                for i in range(0, self.maxWorkers - runningWorkers):
-                    if serverCounter < len(self.serverList):
-
-                        # Create a new thread with all the details
-                        wt = QueryWorker()
-                        wt.server = self.serverList[serverCounter]
-                        wt.domain = domain
-                        wt.recType = recordType
-                        wt.daemon = True
-
-                        # Add it to the worker tracker
-                        workers.append(wt)
-
-                        # Start it
-                        wt.start()
-
-                        serverCounter += 1
-
-            # Pause a little bit
-            time.sleep(0.1)
-
-        # Now colate the results
-        # Group by number of servers with the same response
-        for r in self.results:
-            # Result already in collation
-            if r['results'] in [rs['results'] for rs in self.resultsColated]:
-                cid = [
-                    i for i, rs in enumerate(self.resultsColated)
-                    if r['results'] == rs['results']
-                ][0]
-
-                self.resultsColated[cid]['servers'].append(r['server'])
-            else:
-                self.resultsColated.append(
-                    {
-                        'servers': [
-                            r['server']
-                        ],
-                        'results': r['results'],
-                        'success': r['success']
-                    }
-                )
+        @param  result: A result from a single server
+        @type   result: dict
+        """
 
-        if progress:
-            sys.stdout.write("\n\n")
+        start = time.time()
+
+        # Each answer set has one Answer, however many servers gave it
+        answer = result['answer']
+
+        cid = self.colationIndex.get(answer)
+        if cid is None:
+            cid = self.colationIndex[answer] = len(self.resultsColated)
+            self.resultsColated.append(
+                {
+                    'servers': [
+                        result['server']
+                    ],
+                    'answer': answer,
+                    'results': result['results'],
+                    'success': result['success']
+                }
+            )
+        else:
+            self.resultsColated[cid]['servers'].append(result['server'])
 
-        logging.debug("There are {0} unique results".format(
-            len(self.resultsColated)))
+        # Counted as they come in, the totals are checked after every result
+        self._queried += 1
+        if result['success']:
+            self._successful += 1
+
+        # Keep track of where the answers were seen from
+        if 'agent' in result:
+            agents = self.resultsColated[cid].setdefault('agents', {})
+            agents[result['agent']] = agents.get(result['agent'], 0) + 1
+
+        # Counts only go up, so the most common answer is easy to track
+        if self.topColated is None or len(self.topColated['servers']) < \
+                len(self.resultsColated[cid]['servers']):
+            self.topColated = self.resultsColated[cid]
+
+        self.stats.add('colate', time.time() - start)
 
     def outputStandard(self, extended=False):
         """
         Standard, multi-line output display
         """
 
-        successfulResponses = len(
-            [
-                True for rsp in self.results if rsp['success']
-            ]
-        )
+        successfulResponses = self.successCount()
+        queried = self.queriedCount() if self.partial else len(self.serverList)
 
         sys.stdout.write(""" - RESULTS
 
 I asked {num_servers} servers for {rec_type} records related to {domain},
 {success_responses} responded with records and {error_responses} gave errors
-Here are the results;\n\n\n""".format(
-            num_servers=len(self.serverList),
+""".format(
+            num_servers=queried,
             rec_type=self.recordType,
             domain=self.domain,
             success_responses=successfulResponses,
-            error_responses=len(self.serverList) - successfulResponses
+            error_responses=queried - successfulResponses
         ))
 
+        if self.partial:
+            sys.stdout.write(
+                "I stopped early because the servers {0}, the other {1} "
+                "weren't asked\n".format(
+                    "agreed" if self.consensus == 'agreed'
+                    else "didn't agree",
+                    len(self.serverList) - queried
+                ))
+
+        sys.stdout.write("Here are the results;\n\n\n")
+
         errors = []
 
         for rsp in self.resultsColated:
@@ -385,6 +1380,12 @@ Here are the results;\n\n\n""".format(
                     format(s['ip'], s['provider'], s['country'])
                     for s in rsp['servers']]))
 
+                if 'agents' in rsp:
+                    out.append("\nfrom {0}".format(", ".join([
+                        "{0} ({1})".format(agent, count)
+                        for agent, count in sorted(rsp['agents'].items())
+                    ])))
+
                 out.append("\nresponded with;\n")
             else:
                 out.append("{num_servers} servers responded with;\n".format(
@@ -406,93 +1407,273 @@ Here are the results;\n\n\n""".format(
 
         sys.stdout.write("".join(errors))
 
-    def outputSimple(self):
+    def outputSimple(self, info=True, results=True):
         """
         Simple output mode
+
+        @param  info:       Include the INFO summary lines
+        @param  results:    Include the RESULT and ERROR lines
         """
 
         out = []
         errors = []
 
-        successfulResponses = \
-            len([True for rsp in self.results if rsp['success']])
+        successfulResponses = self.successCount()
 
-        out.append("INFO QUERIED {0}".format(
-            len(self.serverList)))
-        out.append("INFO SUCCESS {0}".format(
-            successfulResponses))
-        out.append("INFO ERROR {0}".format(
-            len(self.serverList) - successfulResponses))
+        queried = self.queriedCount() if self.partial else len(self.serverList)
 
-        for rsp in self.resultsColated:
-            if rsp['success']:
-                out.append("RESULT {0} {1}".format(
-                    len(rsp['servers']),
-                    "|".join(rsp['results'])
-                ))
-            else:
-                errors.append("ERROR {0} {1}".format(
-                    len(rsp['servers']),
-                    "|".join(rsp['results'])
-                ))
+        if info:
+            out.append("INFO QUERIED {0}".format(
+                queried))
+            out.append("INFO SUCCESS {0}".format(
+                successfulResponses))
+            out.append("INFO ERROR {0}".format(
+                queried - successfulResponses))
+            if self.partial:
+                out.append("INFO PARTIAL {0}".format(
+                    self.consensus.upper()))
+
+        if results:
+            for rsp in self.resultsColated:
+                if rsp['success']:
+                    out.append(self._simpleLine(rsp))
+                else:
+                    errors.append(self._simpleLine(rsp))
 
         out += errors
 
         sys.stdout.write("\n".join(out))
         sys.stdout.write("\n")
 
+    def outputSimpleStream(self, result):
+        """
+        Streaming version of the simple output mode
 
-class QueryWorker(threading.Thread):
-    """
-    A single worker, in charge of querying one X{DNS server}
+        Call with each result from L{queryIter}, writes the RESULT or
+        ERROR line for the group the result went into with its updated
+        server count. The last line for each answer is the final count.
 
-    @ivar   server:     Info on the server to query
-    @ivar   domain:     Domain to query for
-    @ivar   recType:    Record type
-    @ivar   result:     Query result
-    """
+        @param  result: A result from a single server
+        @type   result: dict
+        """
+
+        rsp = self.resultsColated[self.colationIndex[result['answer']]]
 
-    server = None
-    domain = None
-    recType = None
-    result = None
+        sys.stdout.write(self._simpleLine(rsp))
+        sys.stdout.write("\n")
+        sys.stdout.flush()
+
+    def outputJSON(self, result):
+        """
+        Streaming NDJSON output mode, one line per server
 
-    def run(self):
+        @param  result: A result from a single server
+        @type   result: dict
         """
-        Do a single DNS query against a server
+
+        sys.stdout.write(json.dumps(self.resultDict(result), sort_keys=True))
+        sys.stdout.write("\n")
+        sys.stdout.flush()
+
+    def resultDict(self, result):
         """
+        A single server's result, ready to be dumped as JSON
 
-        logging.debug("Querying server {0}".format(self.server['ip']))
+        @param  result: A result from a single server
+        @type   result: dict
+        @rtype:         dict
+        """
 
-        try:
-            # Create a DNS resolver query
-            rsvr = dns.resolver.Resolver()
-            rsvr.nameservers = [self.server['ip']]
-            rsvr.lifetime = 5
-            rsvr.timeout = 5
-
-            qry = rsvr.query(self.domain, self.recType)
-
-            # Get the results, sort for consistancy
-            results = sorted([r.to_text() for r in qry])
-            success = True
-        # Handle all the various exceptions
-        except dns.resolver.NXDOMAIN:
-            success = False
-            results = ['NXDOMAIN']
-        except dns.resolver.NoNameservers:
-            success = False
-            results = ['No Nameservers']
-        except dns.resolver.NoAnswer:
-            success = False
-            results = ['No Answer']
-        except dns.resolver.Timeout:
-            success = False
-            results = ['Server Timeout']
-
-        # Save the results
-        self.result = {
-            'server': self.server,
-            'results': results,
-            'success': success
+        line = {
+            'server': dict(result['server']),
+            'domain': result['domain'],
+            'recordType': result['recordType'],
+            'results': result['results'],
+            'success': result['success']
         }
+        if 'agent' in result:
+            line['agent'] = result['agent']
+
+        return line
+
+    def asDict(self, servers=False):
+        """
+        The colated results of the last query, ready to be dumped as JSON
+
+        @param  servers:    Include the servers that gave each answer
+        @rtype:             dict
+        """
+
+        colated = []
+        for rsp in sorted(self.resultsColated,
+                          key=lambda r: len(r['servers']), reverse=True):
+            entry = {
+                'results': rsp['results'],
+                'success': rsp['success'],
+                'count': len(rsp['servers'])
+            }
+            if servers:
+                entry['servers'] = [dict(s) for s in rsp['servers']]
+            if 'agents' in rsp:
+                entry['agents'] = rsp['agents']
+
+            colated.append(entry)
+
+        return {
+            'domain': self.domain,
+            'recordType': self.recordType,
+            'servers': len(self.serverList),
+            'queried': self.queriedCount(),
+            'successful': self.successCount(),
+            'partial': self.partial,
+            'consensus': self.consensus,
+            'results': colated
+        }
+
+    def outputWatch(self, watchRound, simple=False):
+        """
+        Output a summary of a round from L{watch} and what changed in it
+
+        @param  watchRound: A round from L{watch}
+        @param  simple:     Use the simple output format
+        @type   watchRound: dict
+        """
+
+        out = []
+
+        if simple:
+            out.append("ROUND {0} QUERIED {1} PROPAGATED {2} OF {3}".format(
+                watchRound['round'], watchRound['queried'],
+                watchRound['propagated'], watchRound['total']))
+            for count, old, new in watchRound['changes']:
+                out.append("CHANGE {0} {1} > {2}".format(
+                    count,
+                    "|".join(old[1]) if old is not None else "NONE",
+                    "|".join(new[1])))
+        else:
+            out.append(
+                "Round {0}: asked {1} servers, {2} of {3} ({4:.1f}%) now "
+                "give the expected answer".format(
+                    watchRound['round'], watchRound['queried'],
+                    watchRound['propagated'], watchRound['total'],
+                    100.0 * watchRound['propagated'] /
+                    max(watchRound['total'], 1)))
+            for count, old, new in watchRound['changes']:
+                if old is None:
+                    out.append(" - {0} servers responded with {1}".format(
+                        count, ", ".join(new[1])))
+                else:
+                    out.append(" - {0} servers changed from {1} to {2}".format(
+                        count, ", ".join(old[1]), ", ".join(new[1])))
+
+        sys.stdout.write("\n".join(out))
+        sys.stdout.write("\n")
+        sys.stdout.flush()
+
+    def outputDiff(self, diff, simple=False, extended=False):
+        """
+        Output which servers changed their answer between two runs
+
+        @param  diff:       A diff from L{dnsyo.history.HistoryStore.diff}
+        @param  simple:     Use the simple output format
+        @param  extended:   List each server that changed
+        @type   diff:       dict
+        """
+
+        # Group the servers by what changed
+        groups = {}
+        for ip, old, new in diff['changes']:
+            groups.setdefault((old, new), []).append(ip)
+        groups = sorted(groups.items(), key=lambda g: -len(g[1]))
+
+        out = []
+
+        if simple:
+            out.append("DIFF {0} {1} COMPARED {2} CHANGED {3}".format(
+                diff['old']['id'], diff['new']['id'], diff['compared'],
+                len(diff['changes'])))
+            for (old, new), ips in groups:
+                out.append("CHANGE {0} {1} > {2}".format(
+                    len(ips), "|".join(old[1]), "|".join(new[1])))
+                if extended:
+                    for ip in sorted(ips):
+                        out.append("SERVER {0} {1} > {2}".format(
+                            ip, "|".join(old[1]), "|".join(new[1])))
+        else:
+            out.append(
+                "Between run {0} ({1} UTC) and run {2} ({3} UTC) of {4} {5}, "
+                "{6} of the {7} servers asked both times changed their "
+                "answer".format(
+                    diff['old']['id'],
+                    datetime.utcfromtimestamp(diff['old']['started'])
+                    .strftime('%Y-%m-%d %H:%M:%S'),
+                    diff['new']['id'],
+                    datetime.utcfromtimestamp(diff['new']['started'])
+                    .strftime('%Y-%m-%d %H:%M:%S'),
+                    diff['new']['domain'], diff['new']['recordType'],
+                    len(diff['changes']), diff['compared']))
+            for (old, new), ips in groups:
+                out.append(" - {0} servers changed from {1} to {2}".format(
+                    len(ips), ", ".join(old[1]), ", ".join(new[1])))
+                if extended:
+                    for ip in sorted(ips):
+                        out.append("    - {0}".format(ip))
+
+        sys.stdout.write("\n".join(out))
+        sys.stdout.write("\n")
+        sys.stdout.flush()
+
+    def outputRuns(self, runs, simple=False):
+        """
+        Output a list of runs from the history
+
+        @param  runs:   Runs from L{dnsyo.history.HistoryStore.runs}
+        @param  simple: Use the simple output format
+        @type   runs:   list
+        """
+
+        out = []
+        for run in runs:
+            started = datetime.utcfromtimestamp(run['started'])
+            if simple:
+                out.append("RUN {0} {1} {2} {3} {4} OF {5}".format(
+                    run['id'], run['domain'], run['recordType'],
+                    started.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                    run['responses'], run['servers']))
+            else:
+                out.append(
+                    "Run {0}: {1} {2} at {3} UTC, {4} of {5} servers "
+                    "responded".format(
+                        run['id'], run['domain'], run['recordType'],
+                        started.strftime('%Y-%m-%d %H:%M:%S'),
+                        run['responses'], run['servers']))
+
+        if out:
+            sys.stdout.write("\n".join(out))
+            sys.stdout.write("\n")
+            sys.stdout.flush()
+
+    def queriedCount(self):
+        """
+        Number of servers that have responded (or timed out) so far
+        """
+
+        return self._queried
+
+    def successCount(self):
+        """
+        Number of servers that responded with records so far
+        """
+
+        return self._successful
+
+    def _simpleLine(self, rsp):
+        """
+        RESULT or ERROR line for a group of servers
+        """
+
+        return "{0} {1} {2}".format(
+            "RESULT" if rsp['success'] else "ERROR",
+            len(rsp['servers']),
+            "|".join(rsp['results'])
+        )
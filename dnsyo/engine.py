@@ -0,0 +1,1221 @@
+"""
+Query engine, sends all the queries for a run from a single thread
+
+The MIT License (MIT)
+
+Copyright (c) 2013 Sam Rudge (sam@codesam.co.uk)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import errno
+import heapq
+import logging
+import random
+import select
+import socket
+import struct
+import time
+import dns.exception
+import dns.flags
+import dns.inet
+import dns.message
+import dns.rcode
+import dns.rdatatype
+from .records import Result, answers
+
+# Socket errors that just mean "try again later"
+_retryErrors = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+# Response codes from servers that don't understand EDNS
+_noEdnsRcodes = (dns.rcode.FORMERR, dns.rcode.NOTIMP)
+
+
+class QueryEngine(object):
+    """
+    Query lots of X{DNS servers} without a thread for each one
+
+    UDP queries are sent over one non-blocking socket per address family,
+    and replies are matched back to their server by source address and
+    message ID. Truncated replies are retried over TCP, also non-blocking.
+
+    Queries advertise an EDNS0 buffer of L{ednsPayload} bytes, so most
+    large answers (TXT, SPF, MX) fit in one UDP reply. Servers that reply
+    FORMERR or NOTIMP to that are asked again without it, and aren't sent
+    it again. The TCP connection to each server is kept open for the rest
+    of the run, and every truncated query for that server is sent down it
+    without waiting for the answers before, they're matched back by
+    message ID.
+
+    Results are dicts in the same format L{dnsyo.lookup.results} has
+    always used, `server`, `results` and `success`, plus the `domain`
+    and `recordType` that was asked for, `rtt`, the seconds it took the
+    server to respond (None if it didn't) and `retried`, if the query had
+    to be sent more than once, and `ttl`, how long the server will keep
+    giving the same answer (None if we can't tell).
+
+    Rather than always waiting the full timeout, a query that hasn't been
+    answered within the server's usual response time is sent again once
+    (hedged), and servers we have history for are given up on sooner.
+    Response times come from the L{dnsyo.health.HealthStore} if there is
+    one, or from how quickly other servers have responded this run.
+
+    The number of queries in flight is managed the same way TCP manages
+    its congestion window. It starts small and grows with each response,
+    up to maxInFlight, and is halved when queries look to have been lost
+    on the way. That's when a server that usually answers times out, or
+    only answers after being re-sent at its own retransmission timeout
+    (re-sends based on how fast other servers are catch slow servers as
+    well as lost packets, so they don't count). Without any history, it's
+    when more than L{lossRate} of the recent replies needed a re-send.
+    Sending can also be capped at a number of packets per second.
+
+    @cvar   port:           Port to send queries to
+    @cvar   timeout:        Seconds to wait for each server, at most
+    @cvar   minTimeout:     Shortest timeout to give a server
+    @cvar   defaultHedge:   Seconds before re-sending a query when we don't
+                            know how fast the server usually is
+    @cvar   minHedge:       Never re-send a query sooner than this
+    @cvar   minSamples:     Responses needed this run before using their
+                            response times
+    @cvar   bufferSize:     Receive buffer to ask for on the UDP sockets,
+                            replies can arrive faster than we read them
+    @cvar   maxCnameChain:  How many CNAMEs to follow in an answer
+    @cvar   initialWindow:  Queries in flight at the start of a run
+    @cvar   minWindow:      Never cut the queries in flight below this
+    @cvar   rateBurst:      Seconds worth of packets that can be sent at
+                            once when there's a rate limit
+    @cvar   parseCacheSize: Distinct responses to remember the answer for
+    @cvar   ednsPayload:    UDP reply size to advertise with EDNS0, None
+                            to send plain queries
+    @cvar   maxTcpOpen:     Past this many TCP connections, close them
+                            as soon as nothing is waiting on them
+    @cvar   lossRate:       Share of recent replies that can need a
+                            re-send before it's taken as loss, hedging at
+                            the 95th percentile re-sends 5% anyway
+    @cvar   lossSamples:    Roughly how many recent replies the re-send
+                            rate is taken over
+    """
+
+    port = 53
+    timeout = 5
+    minTimeout = 1
+    defaultHedge = 1
+    minHedge = 0.2
+    minSamples = 20
+    bufferSize = 4 * 1024 * 1024
+    maxCnameChain = 16
+    initialWindow = 10
+    minWindow = 1
+    rateBurst = 0.1
+    parseCacheSize = 10000
+    ednsPayload = 1232
+    maxTcpOpen = 100
+    lossRate = 0.1
+    lossSamples = 100
+
+    def __init__(self, maxInFlight=100, timeout=None, health=None,
+                 maxRate=None, stats=None):
+        """
+        Setup the engine
+
+        @param  maxInFlight:    Maximum number of queries waiting for a
+                                response at once
+        @param  timeout:        Override the default per server timeout
+        @param  health:         Past response times for each server
+        @param  maxRate:        Maximum packets to send per second, None
+                                for no limit
+        @param  stats:          Where to record how long sending, waiting
+                                and receiving took
+
+        @type   maxInFlight:    int
+        @type   timeout:        int
+        @type   health:         L{dnsyo.health.HealthStore}
+        @type   maxRate:        float
+        @type   stats:          L{dnsyo.stats.RunStats}
+        """
+
+        self.maxInFlight = maxInFlight
+        if timeout is not None:
+            self.timeout = timeout
+        self.health = health
+        self.maxRate = maxRate
+        self.stats = stats
+
+        self.window = float(min(self.initialWindow, maxInFlight))
+        self._threshold = float(maxInFlight)
+        self._lastBackOff = 0
+        self._tokens = 0
+        self._tokensAt = 0
+
+        self.servers = []
+        self.queries = []
+        self.queryCounter = 0
+        self.skipped = set()
+
+        self._sockets = {}
+        self._pending = {}
+        self._tcp = {}
+        self._tcpServers = {}
+        self._tcpSingle = set()
+        self._deadlines = []
+        self._sendBlocked = False
+        self._rtts = []
+        self._runRto = None
+        self._minRtt = None
+        self._lost = False
+        self._answered = 0
+        self._resendRate = 0.0
+        self._addresses = {}
+        self._templates = {}
+        self._parsed = {}
+        self._noEdns = set()
+
+    def run(self, servers, queries):
+        """
+        Query every server in the list, yielding each result as soon as
+        it's ready
+
+        A new query is sent as soon as one finishes, so there are always
+        up to maxInFlight queries waiting
+
+        @param  servers:    Servers to query
+        @param  queries:    (domain, record type) pairs to ask each server
+
+        @type   servers:    list
+        @type   queries:    list
+
+        @return:            Generator of results
+        """
+
+        self.start(servers, queries)
+
+        try:
+            while not self.finished:
+                for result in self.poll():
+                    yield result
+        finally:
+            self.close()
+
+    def start(self, servers, queries):
+        """
+        Queue up every query against every server in the list
+
+        Each query is sent to all the servers before the next one starts,
+        so no one server gets a burst of queries at once. Nothing is sent
+        until L{poll} is called.
+
+        @param  servers:    Servers to query
+        @param  queries:    (domain, record type) pairs to ask each server
+
+        @type   servers:    list
+        @type   queries:    list
+        """
+
+        self.servers = servers
+        self.queries = queries
+        self.queryCounter = 0
+        self.skipped = set()
+        self._deadlines = []
+        self._rtts = []
+        self._runRto = None
+        self._minRtt = None
+        self._lost = False
+        self._answered = 0
+        self._resendRate = 0.0
+
+        self.window = float(min(self.initialWindow, self.maxInFlight))
+        self._threshold = float(self.maxInFlight)
+        self._lastBackOff = 0
+        if self.maxRate:
+            self._tokens = max(1.0, self.maxRate * self.rateBurst)
+            self._tokensAt = time.time()
+
+    @property
+    def finished(self):
+        """
+        True once every server has been queried and has a result
+        """
+
+        return self.queryCounter >= self.total and len(self._pending) == 0
+
+    @property
+    def total(self):
+        """
+        Total number of queries this run will send
+        """
+
+        return len(self.servers) * len(self.queries)
+
+    def poll(self, wait=None):
+        """
+        Send whatever queries we have room for, then wait for responses
+
+        Returns as soon as any server finishes, or after `wait` seconds
+
+        @param  wait:   Maximum time to block for in seconds, None to
+                        wait until something happens
+        @type   wait:   float
+
+        @return:        Results for the servers that finished
+        @rtype:         list
+        """
+
+        done = []
+
+        started = time.time()
+        self._dispatch(done)
+        started = self._timed('dispatch', started)
+
+        rateLimited = self.queryCounter < self.total and \
+            self.maxRate and self._tokens < 1
+        if self._pending or self._sendBlocked or rateLimited:
+            # Don't sleep past the first server timing out
+            if self._deadlines:
+                untilDeadline = max(0, self._deadlines[0][0] - time.time())
+                if wait is None or untilDeadline < wait:
+                    wait = untilDeadline
+
+            # Or past being allowed to send again
+            if rateLimited:
+                untilToken = (1 - self._tokens) / self.maxRate
+                if wait is None or untilToken < wait:
+                    wait = untilToken
+
+            readers = list(self._sockets.values())
+            writers = []
+            if self._sendBlocked:
+                writers += readers
+            for sock, conn in self._tcp.items():
+                # Replies can come back while later queries are being sent
+                readers.append(sock)
+                if conn['sent'] < len(conn['out']):
+                    writers.append(sock)
+
+            try:
+                if readers or writers:
+                    readable, writable, _ = select.select(
+                        readers, writers, [], wait)
+                else:
+                    # Nothing to wait on but the rate limit
+                    time.sleep(wait)
+                    readable, writable = [], []
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                readable, writable = [], []
+
+            started = self._timed('wait', started)
+
+            for sock in writable:
+                if sock in self._tcp:
+                    self._tcpWrite(sock, done)
+
+            udp = list(self._sockets.values())
+            for sock in readable:
+                if sock in self._tcp:
+                    self._tcpRead(sock, done)
+                elif sock in udp:
+                    # Rather than a TCP connection closed while writing
+                    self._udpRead(sock, done)
+
+            self._expire(done)
+
+            started = self._timed('receive', started)
+
+            # Fill any slots that just freed up straight away
+            self._dispatch(done)
+
+            self._timed('dispatch', started)
+
+        for result in done:
+            self._track(result)
+            if result['rtt'] is not None and not result['retried']:
+                self._observe(result['rtt'])
+                self._grow()
+            elif result['rtt'] is None and self._wasHealthy(result):
+                # A server that usually answers didn't, a packet probably
+                # got lost
+                self._lost = True
+
+        if self._lost:
+            self._lost = False
+            self._backOff()
+
+        return done
+
+    def skip(self, server):
+        """
+        Don't send any more queries to a server this run
+
+        Queries already in flight still finish as normal, the ones that
+        haven't been sent are dropped without a result
+
+        @param  server: The server to skip
+        @type   server: dict
+        """
+
+        self.skipped.add(server['ip'])
+
+    def limit(self, maxInFlight):
+        """
+        Change the maximum number of queries in flight, part way through a
+        run if needed
+
+        Queries already sent aren't affected, but no more are sent until
+        there are fewer than the new limit waiting
+
+        @param  maxInFlight:    The new limit
+        @type   maxInFlight:    int
+        """
+
+        self.maxInFlight = maxInFlight
+        self.window = min(self.window, float(maxInFlight))
+        self._threshold = min(self._threshold, float(maxInFlight))
+
+    def close(self):
+        """
+        Close all the sockets, anything still pending is abandoned
+        """
+
+        for sock in list(self._sockets.values()) + list(self._tcp.keys()):
+            sock.close()
+
+        self._sockets = {}
+        self._tcp = {}
+        self._tcpServers = {}
+        self._pending = {}
+        self._deadlines = []
+
+    def _timed(self, phase, started):
+        """
+        Add the time since `started` to a phase in the stats
+
+        @return:    The time now
+        """
+
+        now = time.time()
+        if self.stats is not None:
+            self.stats.add(phase, now - started)
+
+        return now
+
+    def _socket(self, family):
+        """
+        Get (or create) the UDP socket for an address family
+        """
+
+        if family not in self._sockets:
+            sock = socket.socket(family, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                                self.bufferSize)
+            except socket.error:
+                # Not fatal, we'll just drop more replies on big runs
+                logging.debug("Could not set UDP receive buffer size")
+
+            self._sockets[family] = sock
+
+        return self._sockets[family]
+
+    def _dispatch(self, done):
+        """
+        Send queries until we hit the in flight limit
+        """
+
+        self._sendBlocked = False
+
+        while len(self._pending) < int(self.window) and \
+                self.queryCounter < self.total:
+            query = self.queries[self.queryCounter // len(self.servers)]
+            server = self.servers[self.queryCounter % len(self.servers)]
+
+            if server['ip'] in self.skipped:
+                self.queryCounter += 1
+                continue
+
+            if self.maxRate and not self._takeToken():
+                break
+
+            family, address = self._address(server['ip'])
+            template = self._template(query, server['ip'] not in self._noEdns)
+            key = self._newKey(address)
+            messageId = key[1]
+
+            now = time.time()
+            hedge, timeout, certain = self._timeouts(server)
+            pending = {
+                'server': server,
+                'query': query,
+                'template': template,
+                'wire': struct.pack('!H', messageId) + template['wire'][2:],
+                'family': family,
+                'sent': now,
+                'retried': False,
+                'hedge': now + hedge,
+                'certain': certain,
+                'deadline': now + timeout
+            }
+
+            try:
+                self._socket(family).sendto(
+                    pending['wire'], (server['ip'], self.port))
+            except socket.error as e:
+                if e.args[0] in _retryErrors:
+                    # Socket buffer is full, try again once it's writable
+                    self._sendBlocked = True
+                    break
+
+                logging.debug("Could not send to {0}: {1}".format(
+                    server['ip'], e))
+                done.append(self._error(pending, 'No Nameservers'))
+            else:
+                self._pending[key] = pending
+                if pending['hedge'] < pending['deadline']:
+                    heapq.heappush(self._deadlines,
+                                   (pending['hedge'], 'hedge', key))
+                heapq.heappush(self._deadlines,
+                               (pending['deadline'], 'deadline', key))
+
+            self.queryCounter += 1
+
+    def _newKey(self, address):
+        """
+        Pick a message ID that isn't in use for a server
+
+        @return:    (packed address, message ID)
+        @rtype:     tuple
+        """
+
+        while True:
+            key = (address, random.getrandbits(16))
+            if key not in self._pending:
+                return key
+
+    def _udpRead(self, sock, done):
+        """
+        Read every reply waiting on a UDP socket
+        """
+
+        while True:
+            try:
+                wire, source = sock.recvfrom(65535)
+            except socket.error as e:
+                if e.args[0] in _retryErrors:
+                    return
+                # ICMP errors can surface here, they don't tell us which
+                # server they came from so just skip them
+                logging.debug("UDP receive error: {0}".format(e))
+                continue
+
+            if len(wire) < 12:
+                continue
+
+            try:
+                address = dns.inet.inet_pton(
+                    sock.family, source[0].split('%')[0])
+            except (ValueError, socket.error):
+                continue
+
+            key = (address, struct.unpack('!H', wire[:2])[0])
+            pending = self._pending.get(key)
+            if pending is None:
+                # Late, duplicate or unsolicited
+                continue
+
+            if 'tcpSocket' in pending:
+                continue
+
+            if self._rejectsEdns(pending, wire):
+                self._withoutEdns(key, pending, done)
+                continue
+
+            if not self._isReply(pending, wire):
+                continue
+
+            now = time.time()
+            pending['rtt'] = now - pending['sent']
+            if pending['retried']:
+                self._answeredResend(pending, now)
+
+            if bytearray(wire[2:3])[0] & dns.flags.TC >> 8:
+                self._tcpStart(key, pending, done)
+                continue
+
+            del self._pending[key]
+            done.append(self._parse(pending, wire))
+
+    def _withoutEdns(self, key, pending, done):
+        """
+        Ask a server that didn't understand EDNS again without it
+
+        The query gets a new message ID, so any more replies to the first
+        one are ignored
+        """
+
+        logging.debug("{0} doesn't support EDNS, asking again without "
+                      "it".format(pending['server']['ip']))
+
+        self._noEdns.add(pending['server']['ip'])
+        del self._pending[key]
+
+        key = self._newKey(key[0])
+        pending['template'] = self._template(pending['query'], False)
+        pending['wire'] = struct.pack('!H', key[1]) + \
+            pending['template']['wire'][2:]
+
+        if self.maxRate:
+            self._takeToken(force=True)
+
+        try:
+            self._socket(pending['family']).sendto(
+                pending['wire'], (pending['server']['ip'], self.port))
+        except socket.error as e:
+            logging.debug("Could not send to {0}: {1}".format(
+                pending['server']['ip'], e))
+            done.append(self._error(pending, 'No Nameservers'))
+            return
+
+        self._pending[key] = pending
+        if pending['hedge'] < pending['deadline'] and \
+                pending['hedge'] > time.time():
+            heapq.heappush(self._deadlines, (pending['hedge'], 'hedge', key))
+        heapq.heappush(self._deadlines,
+                       (pending['deadline'], 'deadline', key))
+
+    def _tcpStart(self, key, pending, done):
+        """
+        Retry a truncated query over TCP
+
+        The query goes down the server's open connection if there is one,
+        straight after any others already sent on it. Servers that have
+        closed a connection with queries still waiting get a connection
+        for each query instead.
+        """
+
+        ip = pending['server']['ip']
+        logging.debug("Truncated response from {0}, retrying over "
+                      "TCP".format(ip))
+
+        sock = self._tcpServers.get(ip)
+        if sock is None:
+            sock = self._tcpConnect(pending['family'], ip,
+                                    ip not in self._tcpSingle)
+            if sock is None:
+                del self._pending[key]
+                done.append(self._error(pending, 'No Nameservers'))
+                return
+
+        conn = self._tcp[sock]
+        wire = pending['wire']
+        conn['out'] = conn['out'][conn['sent']:] + \
+            struct.pack('!H', len(wire)) + wire
+        conn['sent'] = 0
+        conn['waiting'][key[1]] = key
+
+        pending['tcpSocket'] = sock
+
+    def _tcpConnect(self, family, ip, pooled=True):
+        """
+        Start connecting to a server over TCP
+
+        @param  pooled: Send the server's other queries down it too
+        @return:        The socket, or None if it couldn't connect
+        """
+
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setblocking(False)
+
+        err = sock.connect_ex((ip, self.port))
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            sock.close()
+            return None
+
+        self._tcp[sock] = {
+            'ip': ip,
+            'out': b'',
+            'sent': 0,
+            'in': b'',
+            # Message ID to key of the queries waiting for a reply
+            'waiting': {},
+            'answered': 0
+        }
+        if pooled:
+            self._tcpServers[ip] = sock
+
+        return sock
+
+    def _tcpClose(self, sock, done):
+        """
+        Close a TCP connection
+
+        If the connection had answered anything, the server is working and
+        just closed it, for being idle or because it only answers one
+        query per connection. Queries still waiting on it are sent again,
+        each on its own connection from now on. Otherwise they're given up
+        on.
+        """
+
+        conn = self._tcp.pop(sock)
+        sock.close()
+        if self._tcpServers.get(conn['ip']) is sock:
+            del self._tcpServers[conn['ip']]
+
+        if conn['waiting'] and conn['answered']:
+            self._tcpSingle.add(conn['ip'])
+
+        for key in conn['waiting'].values():
+            pending = self._pending[key]
+            del pending['tcpSocket']
+
+            if conn['answered']:
+                self._tcpStart(key, pending, done)
+            else:
+                del self._pending[key]
+                done.append(self._error(pending, 'No Nameservers'))
+
+    def _tcpWrite(self, sock, done):
+        """
+        Send (some more of) the queries waiting to go on a TCP connection
+        """
+
+        conn = self._tcp[sock]
+
+        try:
+            conn['sent'] += sock.send(conn['out'][conn['sent']:])
+        except socket.error as e:
+            if e.args[0] not in _retryErrors:
+                self._tcpClose(sock, done)
+
+    def _tcpRead(self, sock, done):
+        """
+        Read (some more of) the responses on a TCP connection
+        """
+
+        conn = self._tcp[sock]
+
+        try:
+            data = sock.recv(65535)
+        except socket.error as e:
+            if e.args[0] not in _retryErrors:
+                self._tcpClose(sock, done)
+            return
+
+        if not data:
+            self._tcpClose(sock, done)
+            return
+
+        conn['in'] += data
+
+        # There could be several responses, and part of another
+        while len(conn['in']) >= 2:
+            length = struct.unpack('!H', conn['in'][:2])[0]
+            if len(conn['in']) < length + 2:
+                break
+
+            wire = conn['in'][2:length + 2]
+            conn['in'] = conn['in'][length + 2:]
+            if len(wire) < 12:
+                continue
+
+            key = conn['waiting'].pop(struct.unpack('!H', wire[:2])[0], None)
+            if key is None:
+                # For a query that's already timed out
+                continue
+
+            pending = self._pending.pop(key)
+            pending['rtt'] = time.time() - pending['sent']
+            conn['answered'] += 1
+
+            if self._isReply(pending, wire):
+                done.append(self._parse(pending, wire))
+            else:
+                done.append(self._error(pending, 'No Nameservers'))
+
+        if not conn['waiting'] and (
+                len(self._tcp) > self.maxTcpOpen or
+                self._tcpServers.get(conn['ip']) is not sock):
+            self._tcpClose(sock, done)
+
+    def _timeouts(self, server):
+        """
+        Work out how long to wait for a server before re-sending the
+        query, and before giving up on it
+
+        @return:    (seconds until re-send, seconds until timeout, whether
+                    the re-send is late enough that needing it means a
+                    packet was lost)
+        @rtype:     tuple
+        """
+
+        entry = None
+        if self.health is not None:
+            entry = self.health.servers.get(server['ip'])
+
+        if entry and entry.get('srtt') is not None:
+            # Same retransmission timeout as TCP uses
+            rto = entry['srtt'] + 4 * entry['rttvar']
+            timeout = min(max(rto * 3, self.minTimeout), self.timeout)
+            hedge = min(max(rto, self.minHedge), timeout / 2.0)
+            return hedge, timeout, hedge >= rto
+
+        if self._runRto is not None:
+            # Haven't seen this server before, so go by how long everyone
+            # else is taking, but give it the full timeout. Some servers
+            # are just slower than that.
+            timeout = self.timeout
+            return min(max(self._runRto, self.minHedge), timeout / 2.0), \
+                timeout, False
+
+        return self.defaultHedge, self.timeout, False
+
+    def _observe(self, rtt):
+        """
+        Add a response time to the distribution for this run
+        """
+
+        self._rtts.append(rtt)
+        if self._minRtt is None or rtt < self._minRtt:
+            self._minRtt = rtt
+
+        # Re-work out the 95th percentile every so often
+        if len(self._rtts) >= self.minSamples and len(self._rtts) % 10 == 0:
+            rtts = sorted(self._rtts)
+            self._runRto = rtts[int(len(rtts) * 0.95)]
+
+    def _grow(self):
+        """
+        Open the window up after a response, quickly at first then by
+        about one query per round trip
+        """
+
+        if self.window < self._threshold:
+            self.window += 1
+        else:
+            self.window += 1 / self.window
+
+        self.window = min(self.window, float(self.maxInFlight))
+
+    def _track(self, result):
+        """
+        Keep the recent re-send rate for the run, so loss can be spotted
+        for servers we have no history for
+
+        Only answered queries count, dead servers are re-sent to as well
+        but never answer, and time out at the end of the run
+        """
+
+        if result['rtt'] is None:
+            return
+
+        resent = 1 if result['retried'] else 0
+        self._answered += 1
+        self._resendRate += (resent - self._resendRate) / self.lossSamples
+
+        if self._answered >= self.lossSamples and \
+                self._resendRate > self.lossRate:
+            self._lost = True
+
+    def _backOff(self):
+        """
+        Halve the window after a lost packet
+
+        Losses usually come in bursts, so it only backs off once per
+        round trip
+        """
+
+        now = time.time()
+        if now - self._lastBackOff < (self._runRto or self.defaultHedge):
+            return
+
+        self._lastBackOff = now
+        self.window = max(self.window / 2, float(self.minWindow))
+        self._threshold = self.window
+
+        # The replies that showed the loss were sent with the old window,
+        # wait for new ones before backing off again
+        self._resendRate = min(self._resendRate, self.lossRate / 2)
+
+        logging.debug("Looks like packets are being lost, cutting queries "
+                      "in flight to {0}".format(int(self.window)))
+
+    def _wasHealthy(self, result):
+        """
+        Check if a server that timed out normally answers
+        """
+
+        if self.health is None or result['results'] != ('Server Timeout',):
+            return False
+
+        entry = self.health.servers.get(result['server']['ip'])
+        return bool(entry) and entry.get('srtt') is not None and \
+            entry.get('streak') == 0
+
+    def _takeToken(self, force=False):
+        """
+        Use up one packet's worth of the rate limit
+
+        @param  force:  Send anyway, even if we're over the limit
+        @return:        If the packet can be sent
+        @rtype:         bool
+        """
+
+        now = time.time()
+        self._tokens = min(
+            self._tokens + (now - self._tokensAt) * self.maxRate,
+            max(1.0, self.maxRate * self.rateBurst))
+        self._tokensAt = now
+
+        if self._tokens < 1 and not force:
+            return False
+
+        self._tokens -= 1
+        return True
+
+    def _hedge(self, pending):
+        """
+        Send a query again, in case the first one was lost
+        """
+
+        pending['retried'] = True
+        pending['resent'] = time.time()
+
+        if self.maxRate:
+            # Re-sends count towards the rate, but they're never held back
+            self._takeToken(force=True)
+
+        try:
+            self._socket(pending['family']).sendto(
+                pending['wire'], (pending['server']['ip'], self.port))
+        except socket.error as e:
+            # We still have the original query, so just keep waiting
+            logging.debug("Could not re-send to {0}: {1}".format(
+                pending['server']['ip'], e))
+
+    def _answeredResend(self, pending, now):
+        """
+        Work out what a reply to a query that was sent twice says
+
+        A reply that comes back quicker after the re-send than the server
+        (or if we don't know, any server) has ever answered must be to the
+        first send, so nothing was lost and the response time is good.
+        Otherwise, if the re-send was at the server's own retransmission
+        timeout, the first send was most likely lost.
+        """
+
+        minRtt = self._minRtt
+        if self.health is not None:
+            entry = self.health.servers.get(pending['server']['ip'])
+            if entry and entry.get('minRtt') is not None:
+                minRtt = entry['minRtt']
+
+        if minRtt is not None and now - pending['resent'] < minRtt:
+            pending['retried'] = False
+        elif pending['certain']:
+            self._lost = True
+
+    def _expire(self, done):
+        """
+        Re-send or time out any queries that have had long enough
+        """
+
+        now = time.time()
+
+        while self._deadlines and self._deadlines[0][0] <= now:
+            deadline, event, key = heapq.heappop(self._deadlines)
+
+            pending = self._pending.get(key)
+            if pending is None or pending[event] != deadline:
+                # Already finished (and maybe the ID has been reused)
+                continue
+
+            if event == 'hedge':
+                if 'tcpSocket' not in pending:
+                    self._hedge(pending)
+                continue
+
+            del self._pending[key]
+            if 'tcpSocket' in pending:
+                sock = pending.pop('tcpSocket')
+                waiting = self._tcp[sock]['waiting']
+                del waiting[key[1]]
+                if not waiting:
+                    # Don't keep a connection that's stopped answering
+                    self._tcpClose(sock, done)
+            pending.pop('rtt', None)
+            done.append(self._error(pending, 'Server Timeout'))
+
+    def _answer(self, request, response):
+        """
+        Find the answer to our question, following any CNAMEs
+
+        @return:    The answer rrset, or None if there isn't one
+        """
+
+        question = request.question[0]
+        qname = question.name
+
+        for i in range(self.maxCnameChain):
+            try:
+                return response.find_rrset(
+                    response.answer, qname, question.rdclass,
+                    question.rdtype)
+            except KeyError:
+                if question.rdtype == dns.rdatatype.CNAME:
+                    return None
+
+            try:
+                cname = response.find_rrset(
+                    response.answer, qname, question.rdclass,
+                    dns.rdatatype.CNAME)
+            except KeyError:
+                return None
+
+            qname = cname[0].target
+
+        return None
+
+    def _address(self, ip):
+        """
+        Address family and packed address of a server
+        """
+
+        address = self._addresses.get(ip)
+        if address is None:
+            family = dns.inet.af_for_address(ip)
+            address = self._addresses[ip] = (
+                family, dns.inet.inet_pton(family, ip))
+
+        return address
+
+    def _template(self, query, edns=True):
+        """
+        Get (or build) the wire format of a query, every server is sent
+        the same bytes apart from the message ID
+
+        @param  edns:   Advertise a bigger UDP buffer with EDNS0, unless
+                        L{ednsPayload} is None
+        """
+
+        edns = bool(edns and self.ednsPayload)
+
+        template = self._templates.get((query, edns))
+        if template is None:
+            if edns:
+                request = dns.message.make_query(
+                    *query, use_edns=0, payload=self.ednsPayload)
+            else:
+                request = dns.message.make_query(*query)
+            wire = request.to_wire()
+            end = self._skipName(bytearray(wire), 12) + 4
+
+            template = self._templates[(query, edns)] = {
+                'request': request,
+                'wire': wire,
+                'edns': edns,
+                'rdtype': request.question[0].rdtype,
+                # Replies have to repeat the question
+                'question': wire[12:end].lower()
+            }
+
+        return template
+
+    def _isReply(self, pending, wire):
+        """
+        Check a message is a reply to our query, the ID has already been
+        matched so just check the QR bit and the question
+        """
+
+        question = pending['template']['question']
+
+        return len(wire) >= 12 + len(question) and \
+            bytearray(wire[2:3])[0] & 0x80 and \
+            wire[4:6] == b'\x00\x01' and \
+            wire[12:12 + len(question)].lower() == question
+
+    def _rejectsEdns(self, pending, wire):
+        """
+        Check if a reply means the server doesn't understand EDNS
+
+        Servers like that often send back just the header with the error,
+        without the question, so a reply with no question is accepted
+        once its ID and address match
+        """
+
+        if not pending['template']['edns']:
+            return False
+
+        flags = bytearray(wire[2:4])
+        if not flags[0] & 0x80 or (flags[1] & 0x0f) not in _noEdnsRcodes:
+            return False
+
+        return wire[4:6] == b'\x00\x00' or self._isReply(pending, wire)
+
+    def _skipName(self, data, offset):
+        """
+        Find the end of a (possibly compressed) name in a message
+
+        @return:    Offset of the first byte after the name
+        """
+
+        while True:
+            length = data[offset]
+            if length == 0:
+                return offset + 1
+            elif length & 0xc0 == 0xc0:
+                return offset + 2
+            offset += length + 1
+
+    def _scan(self, wire):
+        """
+        Walk through a message without fully parsing it
+
+        The bytes that differ between servers giving the same answer, the
+        ID, flags and TTLs, are zeroed so the same answer always looks the
+        same.
+
+        @return:    (the masked message, records) where records are
+                    (section, type, TTL, start, end of the rdata), or None
+                    if the message is broken
+        @rtype:     tuple
+        """
+
+        data = bytearray(wire)
+        records = []
+
+        try:
+            counts = struct.unpack('!4H', wire[4:12])
+
+            data[0:3] = b'\x00\x00\x00'
+            data[3] &= 0x0f
+
+            offset = 12
+            for section, count in enumerate(counts):
+                for i in range(count):
+                    offset = self._skipName(data, offset)
+                    if section == 0:
+                        offset += 4
+                        continue
+
+                    rdtype, rdclass, ttl, length = struct.unpack(
+                        '!HHIH', wire[offset:offset + 10])
+                    if rdtype != dns.rdatatype.OPT:
+                        data[offset + 4:offset + 8] = b'\x00\x00\x00\x00'
+
+                    start = offset + 10
+                    offset = start + length
+                    if offset > len(data):
+                        return None
+
+                    records.append((section, rdtype, ttl, start, offset))
+        except (IndexError, struct.error):
+            return None
+
+        return bytes(data[:offset]), records
+
+    def _parse(self, pending, wire):
+        """
+        Turn a response into a result
+
+        Most servers give the same answer, so only the first response with
+        each answer is fully parsed, and the rest just share its L{Answer}
+        """
+
+        scanned = self._scan(wire)
+        if scanned is None:
+            return self._error(pending, 'No Nameservers')
+
+        masked, records = scanned
+
+        answer = self._parsed.get(masked)
+        if answer is None:
+            try:
+                response = dns.message.from_wire(wire)
+            except dns.exception.DNSException:
+                return self._error(pending, 'No Nameservers')
+
+            answer = answers.intern(*self._outcome(
+                pending['template']['request'], response))
+
+            if len(self._parsed) >= self.parseCacheSize:
+                self._parsed.clear()
+            self._parsed[masked] = answer
+
+        success, results = answer
+
+        if success:
+            ttls = [
+                r[2] for r in records
+                if r[0] == 1 and r[1] == pending['template']['rdtype']]
+        elif results[0] in ('NXDOMAIN', 'No Answer'):
+            # How long the server will remember there isn't an answer,
+            # from the SOA it sent with the response (RFC 2308)
+            ttls = [
+                min(r[2], struct.unpack('!I', wire[r[4] - 4:r[4]])[0])
+                for r in records
+                if r[0] == 2 and r[1] == dns.rdatatype.SOA]
+        else:
+            ttls = []
+
+        return self._result(pending, answer, min(ttls) if ttls else None)
+
+    def _outcome(self, request, response):
+        """
+        Work out the answer (or error) in a response
+
+        @return:    (success, results)
+        @rtype:     tuple
+        """
+
+        rcode = response.rcode()
+
+        if rcode == dns.rcode.NXDOMAIN:
+            return False, ('NXDOMAIN',)
+        elif rcode != dns.rcode.NOERROR:
+            return False, ('No Nameservers',)
+
+        rrset = self._answer(request, response)
+        if rrset is None:
+            return False, ('No Answer',)
+
+        # Sort for consistancy
+        return True, tuple(sorted([r.to_text() for r in rrset]))
+
+    def _result(self, pending, answer, ttl=None):
+        """
+        Create a result
+        """
+
+        return Result(
+            pending['server'],
+            pending['query'][0],
+            pending['query'][1],
+            answer,
+            pending.get('rtt'),
+            pending['retried'],
+            ttl
+        )
+
+    def _error(self, pending, message, ttl=None):
+        """
+        Create an error result
+        """
+
+        return self._result(pending, answers.intern(False, (message,)), ttl)
@@ -0,0 +1,231 @@
+"""
+Keep track of how each resolver has behaved across runs
+
+The MIT License (MIT)
+
+Copyright (c) 2013 Sam Rudge (sam@codesam.co.uk)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from .utils import atomicWrite, lockFile
+
+
+class HealthStore(object):
+    """
+    Per resolver response times and success rates, saved between runs
+
+    Each server has an entry keyed by IP with;
+
+      - `srtt` and `rttvar`, the smoothed round trip time and its
+        variation, worked out the same way TCP does (RFC 6298)
+      - `minRtt`, the quickest it's ever answered
+      - `ok` and `fail`, decaying counts of recent successes and failures
+      - `streak`, the number of failures in a row
+      - `seen`, when it was last queried
+
+    @cvar   deadAfter:      Failures in a row before a server is treated as
+                            dead
+    @cvar   retryDeadAfter: Seconds before a dead server gets another go
+    @cvar   decay:          Weight of past outcomes against each new one
+    @cvar   failures:       Results that mean a server didn't do its job,
+                            answers like NXDOMAIN still count as working
+    @cvar   saveEvery:      Seconds to wait between writes to disk, for
+                            long running processes that save after every
+                            run
+    """
+
+    deadAfter = 3
+    retryDeadAfter = 60 * 60 * 24
+    decay = 0.9
+    failures = ('Server Timeout', 'No Nameservers')
+    saveEvery = 0
+
+    def __init__(self, location):
+        """
+        Load the store
+
+        @param  location:   File the store is kept in
+        @type   location:   str (File path)
+        """
+
+        self.location = os.path.expanduser(location)
+        self.servers = {}
+        self.changed = set()
+        self.saved = 0
+
+        # Runs in different threads can share a store
+        self.lock = threading.RLock()
+
+        self.load()
+
+    def __getstate__(self):
+        # Locks can't be pickled, query processes get their own
+        state = dict(self.__dict__)
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.RLock()
+
+    def load(self):
+        """
+        Read the store from disk, a missing or broken file is just empty
+        """
+
+        self.servers = self._read()
+
+    def _read(self):
+        if not os.path.isfile(self.location):
+            return {}
+
+        try:
+            with open(self.location) as f:
+                servers = json.load(f)
+        except (IOError, ValueError) as e:
+            logging.warning("Could not read resolver health from {0}, "
+                            "starting again ({1})".format(self.location, e))
+            return {}
+
+        return servers if isinstance(servers, dict) else {}
+
+    def save(self, force=False):
+        """
+        Write the servers we've updated back to disk
+
+        Other processes might have updated the store since we loaded it,
+        so it's re-read under a lock and only our servers are replaced
+
+        @param  force:  Save even if it's been less than L{saveEvery}
+                        seconds since the last time
+        """
+
+        with self.lock:
+            if not self.changed:
+                return
+
+            if not force and time.time() - self.saved < self.saveEvery:
+                return
+
+            lock = lockFile(self.location + '.lock')
+            try:
+                servers = self._read()
+                for ip in self.changed:
+                    servers[ip] = self.servers[ip]
+
+                atomicWrite(self.location, json.dumps(servers))
+            finally:
+                lock.close()
+
+            self.servers = servers
+            self.changed = set()
+            self.saved = time.time()
+
+    def record(self, result):
+        """
+        Update a server's entry with the result of a query
+
+        @param  result: A result from L{dnsyo.engine.QueryEngine}
+        @type   result: dict
+        """
+
+        with self.lock:
+            self._record(result)
+
+    def _record(self, result):
+        ip = result['server']['ip']
+        entry = self.servers.setdefault(ip, {
+            'srtt': None,
+            'rttvar': None,
+            'minRtt': None,
+            'ok': 0,
+            'fail': 0,
+            'streak': 0,
+            'seen': 0
+        })
+
+        failed = result['results'][0] in self.failures \
+            if not result['success'] else False
+
+        entry['ok'] = entry['ok'] * self.decay + (0 if failed else 1)
+        entry['fail'] = entry['fail'] * self.decay + (1 if failed else 0)
+        entry['streak'] = entry['streak'] + 1 if failed else 0
+        entry['seen'] = time.time()
+
+        # If the query was sent more than once we can't tell which one
+        # was answered, so the response time isn't useful
+        rtt = result.get('rtt')
+        if rtt is not None and not result.get('retried'):
+            if entry['srtt'] is None:
+                entry['srtt'] = rtt
+                entry['rttvar'] = rtt / 2
+            else:
+                entry['rttvar'] = 0.75 * entry['rttvar'] + \
+                    0.25 * abs(entry['srtt'] - rtt)
+                entry['srtt'] = 0.875 * entry['srtt'] + 0.125 * rtt
+
+            if entry.get('minRtt') is None or rtt < entry['minRtt']:
+                entry['minRtt'] = rtt
+
+        self.changed.add(ip)
+
+    def isDead(self, ip):
+        """
+        Check if a server has failed enough times in a row recently that
+        it's not worth asking
+
+        @rtype: bool
+        """
+
+        entry = self.servers.get(ip)
+        if entry is None:
+            return False
+
+        return entry['streak'] >= self.deadAfter and \
+            entry['seen'] > time.time() - self.retryDeadAfter
+
+    def weight(self, ip):
+        """
+        How much a server should be favoured when picking which to query
+
+        Reliable, fast servers get the highest weight. Servers we haven't
+        seen before get the same weight as one that's failed as often as
+        it's worked, so they still get picked.
+
+        @rtype: float
+        """
+
+        entry = self.servers.get(ip)
+        if entry is None:
+            return 0.5
+
+        # Success rate, starting from 50/50
+        reliability = (entry['ok'] + 1.0) / (entry['ok'] + entry['fail'] + 2)
+
+        # Anything under 100ms is as good as it gets
+        if entry['srtt'] is not None:
+            reliability /= max(1, entry['srtt'] * 10)
+
+        return max(reliability, 0.001)
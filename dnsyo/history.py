@@ -0,0 +1,374 @@
+"""
+Keep every server's answers from past runs, to see how they've changed
+
+The MIT License (MIT)
+
+Copyright (c) 2013 Sam Rudge (sam@codesam.co.uk)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import json
+import os
+import sqlite3
+import time
+
+
+def parseAge(age):
+    """
+    Turn an age like `90s`, `30m`, `2h` or `1d` into seconds, a plain
+    number is seconds
+
+    @rtype: float
+    """
+
+    units = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 60 * 60 * 24}
+
+    age = str(age).strip().lower()
+    multiplier = units.get(age[-1:])
+    if multiplier is not None:
+        age = age[:-1]
+
+    try:
+        return float(age) * (multiplier or 1)
+    except ValueError:
+        raise ValueError("{0} is not a valid age".format(age))
+
+
+class HistoryStore(object):
+    """
+    Each run's results, saved to an SQLite database
+
+    A run is one query, a domain and type, against a set of servers.
+    Every server's answer is kept with its response time and TTL, and
+    each distinct answer set is only stored once.
+
+    Runs are indexed by query and by time, results by run and by server,
+    so finding a run and comparing two of them only reads the rows that
+    are needed.
+
+    @cvar   schema:     Statements to create the tables and indexes
+    """
+
+    schema = [
+        """CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY,
+            domain TEXT NOT NULL,
+            recordType TEXT NOT NULL,
+            started REAL NOT NULL,
+            servers INTEGER NOT NULL,
+            responses INTEGER NOT NULL
+        )""",
+        """CREATE INDEX IF NOT EXISTS runsByQuery
+            ON runs (domain, recordType, started)""",
+        """CREATE INDEX IF NOT EXISTS runsByTime ON runs (started)""",
+        """CREATE TABLE IF NOT EXISTS answers (
+            id INTEGER PRIMARY KEY,
+            success INTEGER NOT NULL,
+            results TEXT NOT NULL,
+            UNIQUE (success, results)
+        )""",
+        """CREATE TABLE IF NOT EXISTS results (
+            run INTEGER NOT NULL,
+            ip TEXT NOT NULL,
+            answer INTEGER NOT NULL,
+            rtt REAL,
+            ttl INTEGER,
+            PRIMARY KEY (run, ip)
+        )""",
+        """CREATE INDEX IF NOT EXISTS resultsByServer ON results (ip, run)"""
+    ]
+
+    def __init__(self, location):
+        """
+        Open the store, creating it if it's not there
+
+        @param  location:   File the store is kept in
+        @type   location:   str (File path)
+        """
+
+        self.location = os.path.expanduser(location)
+
+        # Other processes might be writing to it too, wait for them
+        self.db = sqlite3.connect(self.location, timeout=30)
+        with self.db:
+            for statement in self.schema:
+                self.db.execute(statement)
+
+        # Answer set ids, both ways
+        self._ids = {}
+        self._answers = {}
+
+    def save(self, domain, recordType, results, started=None, servers=None):
+        """
+        Add a run, all in one transaction
+
+        @param  domain:     Domain that was queried
+        @param  recordType: Type of record that was queried
+        @param  results:    Every server's result
+        @param  started:    When the run started, defaults to now
+        @param  servers:    How many servers were asked, if it's more than
+                            responded
+
+        @type   domain:     str
+        @type   recordType: str
+        @type   results:    list of L{dnsyo.records.Result}
+        @type   started:    float
+        @type   servers:    int
+
+        @return:            The run's id
+        @rtype:             int
+        """
+
+        results = list(results)
+
+        try:
+            return self._save(domain, recordType, results, started, servers)
+        except sqlite3.Error:
+            # Any answers added in the transaction are gone
+            self._ids = {}
+            self._answers = {}
+            raise
+
+    def _save(self, domain, recordType, results, started, servers):
+        with self.db:
+            run = self.db.execute(
+                "INSERT INTO runs (domain, recordType, started, servers, "
+                "responses) VALUES (?, ?, ?, ?, ?)",
+                (domain, recordType, started or time.time(),
+                 max(servers or 0, len(results)), len(results))
+            ).lastrowid
+
+            self.db.executemany(
+                "INSERT OR REPLACE INTO results (run, ip, answer, rtt, ttl) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(run, r['server']['ip'],
+                  self._answerId(r['success'], r['results']),
+                  r.get('rtt'), r.get('ttl'))
+                 for r in results]
+            )
+
+        return run
+
+    def _answerId(self, success, results):
+        """
+        Get the id of an answer set, adding it if it's new
+        """
+
+        key = (bool(success), tuple(results))
+
+        answer = self._ids.get(key)
+        if answer is None:
+            values = (int(key[0]), json.dumps(list(key[1])))
+            self.db.execute(
+                "INSERT OR IGNORE INTO answers (success, results) "
+                "VALUES (?, ?)", values)
+            answer = self.db.execute(
+                "SELECT id FROM answers WHERE success = ? AND results = ?",
+                values).fetchone()[0]
+
+            self._ids[key] = answer
+            self._answers[answer] = key
+
+        return answer
+
+    def _answer(self, answer):
+        """
+        Get an answer set by its id
+
+        @return:    (success, results)
+        @rtype:     tuple
+        """
+
+        key = self._answers.get(answer)
+        if key is None:
+            success, results = self.db.execute(
+                "SELECT success, results FROM answers WHERE id = ?",
+                (answer,)).fetchone()
+            key = (bool(success), tuple([str(r) for r in
+                                         json.loads(results)]))
+
+            self._ids[key] = answer
+            self._answers[answer] = key
+
+        return key
+
+    def runs(self, domain=None, recordType=None, limit=20):
+        """
+        The most recent runs, newest first
+
+        @param  domain:     Only runs for this domain
+        @param  recordType: Only runs for this record type
+        @param  limit:      How many runs to get
+
+        @rtype:             list of dict
+        """
+
+        where = []
+        args = []
+        if domain is not None:
+            where.append("domain = ?")
+            args.append(domain)
+        if recordType is not None:
+            where.append("recordType = ?")
+            args.append(recordType.upper())
+
+        return [self._run(row) for row in self.db.execute(
+            "SELECT id, domain, recordType, started, servers, responses "
+            "FROM runs {0} ORDER BY started DESC LIMIT ?".format(
+                "WHERE " + " AND ".join(where) if where else ""),
+            args + [limit])]
+
+    def run(self, run):
+        """
+        A run by its id, or None if there isn't one
+
+        @rtype: dict
+        """
+
+        row = self.db.execute(
+            "SELECT id, domain, recordType, started, servers, responses "
+            "FROM runs WHERE id = ?", (run,)).fetchone()
+
+        return self._run(row) if row is not None else None
+
+    def _run(self, row):
+        return {
+            'id': row[0],
+            'domain': str(row[1]),
+            'recordType': str(row[2]),
+            'started': row[3],
+            'servers': row[4],
+            'responses': row[5]
+        }
+
+    def findRun(self, spec, domain=None, recordType=None):
+        """
+        Find a run from a run id, or an age like `1h` meaning the newest
+        run of the query from at least that long ago
+
+        @param  spec:       Run id or age
+        @param  domain:     Domain the run was for, needed with an age
+        @param  recordType: Record type the run was for
+
+        @rtype:             dict
+        """
+
+        spec = str(spec).strip()
+
+        if spec.isdigit():
+            run = self.run(int(spec))
+            if run is None:
+                raise ValueError("There's no run {0}".format(spec))
+            return run
+
+        if not domain or not recordType:
+            raise ValueError("A domain and type are needed to find a run "
+                             "by age")
+
+        before = time.time() - parseAge(spec)
+        row = self.db.execute(
+            "SELECT id, domain, recordType, started, servers, responses "
+            "FROM runs WHERE domain = ? AND recordType = ? AND started <= ? "
+            "ORDER BY started DESC LIMIT 1",
+            (domain, recordType.upper(), before)).fetchone()
+        if row is None:
+            raise ValueError("There are no runs for {0} {1} from {2} "
+                             "ago".format(domain, recordType.upper(), spec))
+
+        return self._run(row)
+
+    def diff(self, old, new):
+        """
+        Compare two runs, finding the servers whose answer changed
+
+        Only servers asked in both runs are compared. The earlier run's
+        results are read in order from the results index, each one
+        looking up the same server in the later run by its key.
+
+        @param  old:    Id of the earlier run
+        @param  new:    Id of the later run
+
+        @return:        `old` and `new`, the runs, `compared`, how many
+                        servers were in both, and `changes`, a list of
+                        (ip, old answer, new answer) where answers are
+                        (success, results)
+        @rtype:         dict
+        """
+
+        oldRun = self.run(old)
+        newRun = self.run(new)
+        if oldRun is None or newRun is None:
+            raise ValueError("There's no run {0}".format(
+                old if oldRun is None else new))
+
+        compared = 0
+        changes = []
+        for ip, oldAnswer, newAnswer in self.db.execute(
+                "SELECT a.ip, a.answer, b.answer FROM results a "
+                "JOIN results b ON b.run = ? AND b.ip = a.ip "
+                "WHERE a.run = ?", (new, old)):
+            compared += 1
+            if oldAnswer != newAnswer:
+                changes.append((str(ip), self._answer(oldAnswer),
+                                self._answer(newAnswer)))
+
+        return {
+            'old': oldRun,
+            'new': newRun,
+            'compared': compared,
+            'changes': changes
+        }
+
+    def serverHistory(self, ip, domain=None, recordType=None, limit=100):
+        """
+        A server's answers over time, newest first
+
+        @param  ip:         The server
+        @param  domain:     Only runs for this domain
+        @param  recordType: Only runs for this record type
+        @param  limit:      How many answers to get
+
+        @return:            (run, answer) pairs, answers are
+                            (success, results)
+        @rtype:             list
+        """
+
+        where = ["results.ip = ?"]
+        args = [ip]
+        if domain is not None:
+            where.append("runs.domain = ?")
+            args.append(domain)
+        if recordType is not None:
+            where.append("runs.recordType = ?")
+            args.append(recordType.upper())
+
+        return [
+            (self._run(row[:6]), self._answer(row[6]))
+            for row in self.db.execute(
+                "SELECT runs.id, runs.domain, runs.recordType, runs.started, "
+                "runs.servers, runs.responses, results.answer "
+                "FROM results JOIN runs ON runs.id = results.run "
+                "WHERE {0} ORDER BY results.run DESC LIMIT ?".format(
+                    " AND ".join(where)),
+                args + [limit])
+        ]
+
+    def close(self):
+        self.db.close()
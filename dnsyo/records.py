@@ -0,0 +1,324 @@
+"""
+Compact records for resolvers and their results
+
+The MIT License (MIT)
+
+Copyright (c) 2013 Sam Rudge (sam@codesam.co.uk)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import threading
+import weakref
+
+try:
+    from sys import intern
+except ImportError:
+    # A builtin on Python 2
+    pass
+
+
+def _intern(value):
+    """
+    Intern a string, so every record with the same value shares one copy
+    """
+
+    try:
+        return intern(value)
+    except TypeError:
+        # None, or unicode on Python 2
+        return value
+
+
+class Record(object):
+    """
+    A fixed set of fields, without the memory overhead of a dict per
+    record, that can still be used like one
+
+    Fields that haven't been set act like missing keys, so
+    `record['field']`, `record.get('field')`, `'field' in record` and
+    `dict(record)` all work the same as they would on a dict.
+
+    @cvar   _keys:      The fields, in order, that can be read as keys
+    """
+
+    __slots__ = ()
+    _keys = ()
+    _fields = frozenset()
+
+    def __getitem__(self, key):
+        if key not in self._fields:
+            raise KeyError(key)
+
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in self._fields:
+            raise KeyError(key)
+
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self._fields and hasattr(self, key)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        if not isinstance(other, (Record, dict)):
+            return NotImplemented
+
+        return dict(self.items()) == dict(other.items())
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "{0}({1!r})".format(type(self).__name__, dict(self.items()))
+
+    def __getstate__(self):
+        return dict(self.items())
+
+    def __setstate__(self, state):
+        for key, value in state.items():
+            setattr(self, key, value)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return [k for k in self._keys if hasattr(self, k)]
+
+    def items(self):
+        return [(k, getattr(self, k)) for k in self.keys()]
+
+
+class Server(Record):
+    """
+    A resolver from the X{resolver list}
+
+    Country and provider strings are interned, there are only a few
+    hundred of each across thousands of servers.
+    """
+
+    __slots__ = ('country', 'ip', 'provider', 'reverse')
+    _keys = __slots__
+    _fields = frozenset(_keys)
+
+    def __init__(self, ip, country=None, provider=None, reverse=None):
+        """
+        @param  ip:         Address of the server
+        @param  country:    Two letter country code
+        @param  provider:   Who runs it, `AS name - organisation`
+        @param  reverse:    Its reverse DNS name
+
+        @type   ip:         str
+        @type   country:    str
+        @type   provider:   str
+        @type   reverse:    str
+        """
+
+        self.ip = ip
+        if country is not None:
+            self.country = _intern(country)
+        if provider is not None:
+            self.provider = _intern(provider)
+        if reverse is not None:
+            self.reverse = reverse
+
+    @classmethod
+    def fromDict(cls, server):
+        """
+        Make a record from a server in the list, or anything else that
+        has the same keys
+        """
+
+        return cls(server.get('ip'), server.get('country'),
+                   server.get('provider'), server.get('reverse'))
+
+    def row(self):
+        """
+        The fields as a tuple, in the order L{Server} takes them, for
+        storing the list compactly
+
+        @rtype: tuple
+        """
+
+        return (self.get('ip'), self.get('country'), self.get('provider'),
+                self.get('reverse'))
+
+
+class Answer(object):
+    """
+    One distinct answer set, shared by every result that gave it
+
+    Answers are only made by L{AnswerTable.intern}, so two results have
+    the same answer exactly when they have the same L{Answer}, and
+    comparing or grouping them is just comparing objects. It unpacks
+    like a `(success, results)` tuple.
+    """
+
+    __slots__ = ('success', 'results', '__weakref__')
+
+    def __init__(self, success, results):
+        """
+        @param  success:    Whether the answer has records
+        @param  results:    The sorted records, or the error
+        @type   success:    bool
+        @type   results:    tuple
+        """
+
+        self.success = success
+        self.results = results
+
+    def __iter__(self):
+        return iter((self.success, self.results))
+
+    def __repr__(self):
+        return "Answer({0!r}, {1!r})".format(self.success, self.results)
+
+    def __reduce__(self):
+        # Answers sent between processes are looked up again at the other
+        # end, so they're shared there too
+        return _internAnswer, (self.success, self.results)
+
+
+class AnswerTable(object):
+    """
+    Every distinct answer set in use, each kept once
+
+    Thousands of servers usually give a handful of different answers, so
+    results all share the L{Answer} for theirs. An answer is dropped from
+    the table as soon as nothing refers to it any more, so long running
+    processes that see thousands of different answers over time only
+    keep the ones their current results have.
+    """
+
+    def __init__(self):
+        self.ids = weakref.WeakValueDictionary()
+        self.lock = threading.Lock()
+
+    def intern(self, success, results):
+        """
+        Get the answer for an answer set, adding it if it's new
+
+        @param  success:    Whether the answer has records
+        @param  results:    The sorted records, or the error
+        @type   success:    bool
+        @type   results:    tuple
+
+        @rtype:             L{Answer}
+        """
+
+        key = (success, tuple(results))
+
+        answer = self.ids.get(key)
+        if answer is None:
+            # Runs in different threads share the table
+            with self.lock:
+                answer = self.ids.get(key)
+                if answer is None:
+                    answer = self.ids[key] = Answer(*key)
+
+        return answer
+
+    def __len__(self):
+        return len(self.ids)
+
+
+# Shared by everything in the process
+answers = AnswerTable()
+
+
+def _internAnswer(success, results):
+    return answers.intern(success, results)
+
+
+class Result(Record):
+    """
+    One server's answer to a query
+
+    The answer is stored as its L{Answer} from L{answers}, `results` and
+    `success` are read from there. Answers with records have them as a
+    sorted tuple, failures have a tuple of the error.
+
+    `agent` is only set on results from L{dnsyo.remote.RemoteEngine}.
+    """
+
+    __slots__ = ('server', 'domain', 'recordType', 'answer', 'rtt',
+                 'retried', 'ttl', 'agent')
+    _keys = ('server', 'domain', 'recordType', 'answer', 'results',
+             'success', 'rtt', 'retried', 'ttl', 'agent')
+    _fields = frozenset(_keys)
+
+    def __init__(self, server, domain, recordType, answer, rtt=None,
+                 retried=False, ttl=None):
+        """
+        @param  server:     The server that answered
+        @param  domain:     Domain that was queried
+        @param  recordType: Type of record that was queried
+        @param  answer:     The answer, from L{answers}
+        @param  rtt:        Seconds the server took to respond
+        @param  retried:    If the query had to be sent more than once
+        @param  ttl:        Seconds the answer can be cached for
+
+        @type   server:     L{Server}
+        @type   domain:     str
+        @type   recordType: str
+        @type   answer:     L{Answer}
+        @type   rtt:        float
+        @type   retried:    bool
+        @type   ttl:        int
+        """
+
+        self.server = server
+        self.domain = domain
+        self.recordType = recordType
+        self.answer = answer
+        self.rtt = rtt
+        self.retried = retried
+        self.ttl = ttl
+
+    @property
+    def success(self):
+        return self.answer.success
+
+    @property
+    def results(self):
+        return self.answer.results
+
+    def __setstate__(self, state):
+        # Both come from the answer
+        state = dict(state)
+        del state['success']
+        del state['results']
+
+        Record.__setstate__(self, state)
@@ -0,0 +1,538 @@
+"""
+Run queries from several hosts at once
+
+A coordinator splits the servers between agents, each agent queries its
+share and streams the results back. Messages are one JSON object per line.
+
+The coordinator sends each agent a job;
+
+    {"key": ..., "servers": [ip, ...], "queries": [[domain, type], ...],
+     "maxInFlight": ..., "maxRate": ...}
+
+and, while the job is running, {"skip": ip} to stop querying a server.
+The agent sends back a line for each result;
+
+    {"ip": ..., "query": index, "results": [...], "success": ...,
+     "rtt": ..., "retried": ..., "ttl": ...}
+
+then {"done": true}, or {"error": message} if it won't run the job.
+
+The MIT License (MIT)
+
+Copyright (c) 2013 Sam Rudge (sam@codesam.co.uk)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import errno
+import json
+import logging
+import select
+import socket
+import time
+from .records import Result, Server, answers
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+
+def parseAddress(address, defaultHost='127.0.0.1'):
+    """
+    Split a `host:port` (or just `port`) string
+
+    @return:    (host, port)
+    @rtype:     tuple
+    """
+
+    host, sep, port = str(address).rpartition(':')
+    host = host.strip('[]') or defaultHost
+
+    try:
+        port = int(port)
+    except ValueError:
+        raise ValueError("{0} is not a valid address".format(address))
+
+    return host, port
+
+
+class LineSocket(object):
+    """
+    Read and write lines of JSON on a socket
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = b''
+        self.closed = False
+
+    def send(self, message):
+        self.sock.sendall(
+            json.dumps(message, separators=(',', ':')).encode('utf-8') +
+            b'\n')
+
+    def receive(self):
+        """
+        Read whatever is waiting on the socket
+
+        @return:    The complete messages read
+        @rtype:     list
+        """
+
+        try:
+            data = self.sock.recv(65536)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return []
+            data = b''
+
+        if not data:
+            self.closed = True
+            return []
+
+        self.buffer += data
+        lines = self.buffer.split(b'\n')
+        self.buffer = lines.pop()
+
+        return [json.loads(line.decode('utf-8')) for line in lines if line]
+
+    def readLine(self):
+        """
+        Block until a whole message has arrived
+
+        @return:    The message, or None if the socket closed first
+        """
+
+        while b'\n' not in self.buffer:
+            data = self.sock.recv(65536)
+            if not data:
+                return None
+            self.buffer += data
+
+        line, self.buffer = self.buffer.split(b'\n', 1)
+        return json.loads(line.decode('utf-8'))
+
+
+class RemoteEngine(object):
+    """
+    Query a list of servers from several agents at once
+
+    Works like a L{dnsyo.engine.QueryEngine}, but the servers are dealt out
+    between agents (see L{serveAgent}) that query them from their own
+    hosts. Each agent gets the full in flight and rate limits, since
+    they're sending from different places.
+
+    Results are yielded as they're streamed back, with the `agent` that
+    queried the server added. If an agent drops out, the servers it
+    hadn't finished are handed to another agent.
+
+    @cvar   connectTimeout: Seconds to wait when connecting to an agent
+    @cvar   idleTimeout:    Seconds an agent can go without sending
+                            anything before it's given up on
+    """
+
+    connectTimeout = 10
+    idleTimeout = 60
+
+    def __init__(self, agents, maxInFlight=100, maxRate=None, key=None):
+        """
+        Setup the engine
+
+        @param  agents:         `host:port` of each agent
+        @param  maxInFlight:    Maximum number of queries waiting for a
+                                response at once, on each agent
+        @param  maxRate:        Maximum packets to send per second, on each
+                                agent
+        @param  key:            Shared key the agents were started with
+
+        @type   agents:         list
+        @type   maxInFlight:    int
+        @type   maxRate:        float
+        @type   key:            str
+        """
+
+        self.agents = agents
+        self.maxInFlight = maxInFlight
+        self.maxRate = maxRate
+        self.key = key
+
+        self.queries = []
+        self.servers = {}
+        self.remaining = set()
+        self._connections = []
+
+    def run(self, servers, queries):
+        """
+        Query every server in the list from the agents, yielding each
+        result as soon as it arrives
+
+        @param  servers:    Servers to query
+        @param  queries:    (domain, record type) pairs to ask each server
+
+        @type   servers:    list
+        @type   queries:    list
+
+        @return:            Generator of results
+        """
+
+        self.queries = list(queries)
+        self.servers = dict((s['ip'], s) for s in servers)
+
+        # Every (server, query) that still needs a result
+        self.remaining = set(
+            (s['ip'], q) for s in servers for q in range(len(queries)))
+
+        try:
+            live = [a for a in self.agents if self._connect(a, [])]
+            if not live:
+                raise EnvironmentError("Could not connect to any agents")
+
+            # Deal the servers out so each agent gets a similar mix
+            for i, connection in enumerate(self._connections):
+                self._start(connection, [
+                    s['ip'] for s in servers[i::len(self._connections)]])
+
+            while self._connections:
+                for result in self._poll():
+                    yield result
+        finally:
+            self.close()
+
+    def skip(self, server):
+        """
+        Don't send any more queries to a server this run
+
+        @param  server: The server to skip
+        @type   server: dict
+        """
+
+        for q in range(len(self.queries)):
+            self.remaining.discard((server['ip'], q))
+
+        for connection in self._connections:
+            if server['ip'] in connection['servers']:
+                try:
+                    connection['socket'].send({'skip': server['ip']})
+                except socket.error:
+                    pass
+
+    def close(self):
+        """
+        Disconnect from all the agents, anything still pending is abandoned
+        """
+
+        for connection in self._connections:
+            connection['socket'].sock.close()
+
+        self._connections = []
+
+    def _connect(self, agent, exclude):
+        """
+        Connect to an agent
+
+        @return:    The connection, or None if the agent isn't there
+        """
+
+        if agent in exclude:
+            return None
+
+        try:
+            sock = socket.create_connection(
+                parseAddress(agent), self.connectTimeout)
+        except (socket.error, ValueError) as e:
+            logging.warning("Could not connect to agent {0}: {1}".format(
+                agent, e))
+            return None
+
+        connection = {
+            'agent': agent,
+            'socket': LineSocket(sock),
+            'servers': set(),
+            'lastHeard': time.time()
+        }
+        self._connections.append(connection)
+
+        return connection
+
+    def _start(self, connection, servers):
+        """
+        Send an agent its share of the servers
+        """
+
+        connection['servers'] = set(servers)
+        connection['lastHeard'] = time.time()
+
+        logging.debug("Sending {0} servers to agent {1}".format(
+            len(servers), connection['agent']))
+
+        connection['socket'].send({
+            'key': self.key,
+            'servers': servers,
+            'queries': self.queries,
+            'maxInFlight': self.maxInFlight,
+            'maxRate': self.maxRate
+        })
+        connection['socket'].sock.setblocking(False)
+
+    def _poll(self):
+        """
+        Read results from any agents that have sent some
+
+        @return:    The results
+        @rtype:     list
+        """
+
+        done = []
+
+        readable, _, _ = select.select(
+            [c['socket'].sock for c in self._connections], [], [], 1)
+
+        for connection in list(self._connections):
+            if connection['socket'].sock in readable:
+                connection['lastHeard'] = time.time()
+
+                try:
+                    messages = connection['socket'].receive()
+                except ValueError as e:
+                    logging.warning("Agent {0} sent something we couldn't "
+                                    "read: {1}".format(connection['agent'], e))
+                    self._failed(connection)
+                    continue
+
+                for message in messages:
+                    if 'error' in message:
+                        logging.warning(
+                            "Agent {0} refused the job: {1}".format(
+                                connection['agent'], message['error']))
+                        self._failed(connection)
+                        break
+                    elif 'done' in message:
+                        self._finished(connection)
+                        break
+
+                    result = self._result(connection, message)
+                    if result is not None:
+                        done.append(result)
+                else:
+                    if connection['socket'].closed:
+                        self._failed(connection)
+
+            elif time.time() - connection['lastHeard'] > self.idleTimeout:
+                logging.warning("Agent {0} stopped responding".format(
+                    connection['agent']))
+                self._failed(connection)
+
+        return done
+
+    def _result(self, connection, message):
+        """
+        Turn a message from an agent back into a full result
+        """
+
+        pair = (message['ip'], message['query'])
+        if pair not in self.remaining:
+            # Already had this one from another agent
+            return None
+
+        self.remaining.discard(pair)
+        domain, recordType = self.queries[message['query']]
+
+        result = Result(
+            self.servers[message['ip']],
+            domain,
+            recordType,
+            answers.intern(message['success'], message['results']),
+            message.get('rtt'),
+            message.get('retried', False),
+            message.get('ttl')
+        )
+        result['agent'] = connection['agent']
+
+        return result
+
+    def _finished(self, connection):
+        connection['socket'].sock.close()
+        self._connections.remove(connection)
+
+        # Anything it didn't send back still needs doing
+        if any([(ip, q) in self.remaining
+                for ip in connection['servers']
+                for q in range(len(self.queries))]):
+            self._failed(connection, closed=True)
+
+    def _failed(self, connection, closed=False):
+        """
+        Give the servers an agent didn't finish to another one
+        """
+
+        if not closed:
+            connection['socket'].sock.close()
+            self._connections.remove(connection)
+
+        leftover = [
+            ip for ip in connection['servers']
+            if any([(ip, q) in self.remaining
+                    for q in range(len(self.queries))])
+        ]
+        if not leftover:
+            return
+
+        failed = [connection['agent']]
+        for other in sorted(self._connections,
+                            key=lambda c: len(c['servers'])):
+            if other['agent'] in failed:
+                continue
+
+            replacement = self._connect(other['agent'], failed)
+            if replacement is None:
+                failed.append(other['agent'])
+                continue
+
+            logging.warning("Agent {0} didn't finish, sending its {1} "
+                            "servers to {2}".format(
+                                connection['agent'], len(leftover),
+                                other['agent']))
+            self._start(replacement, leftover)
+            return
+
+        raise EnvironmentError(
+            "Agent {0} didn't finish and there are no other agents to send "
+            "its servers to".format(connection['agent']))
+
+
+class AgentHandler(socketserver.BaseRequestHandler):
+    """
+    Run a job from a coordinator
+    """
+
+    def handle(self):
+        connection = LineSocket(self.request)
+
+        try:
+            job = connection.readLine()
+        except ValueError:
+            job = None
+        if job is None:
+            return
+
+        if self.server.key is not None and job.get('key') != self.server.key:
+            logging.warning("Refused a job from {0}, wrong key".format(
+                self.client_address[0]))
+            connection.send({'error': 'Wrong key'})
+            return
+
+        if not job.get('servers'):
+            connection.send({'done': True})
+            return
+
+        lookup = self.server.lookupFactory()
+        lookup.serverList = [Server(ip) for ip in job['servers']]
+        lookup.maxWorkers = min(
+            lookup.maxWorkers, job.get('maxInFlight') or lookup.maxWorkers)
+        if job.get('maxRate'):
+            lookup.maxRate = min(lookup.maxRate or job['maxRate'],
+                                 job['maxRate'])
+
+        queries = [tuple(q) for q in job['queries']]
+        index = dict((tuple(q), i) for i, q in enumerate(queries))
+
+        logging.info("Running {0} queries against {1} servers for "
+                     "{2}".format(len(queries), len(lookup.serverList),
+                                  self.client_address[0]))
+
+        self.request.setblocking(False)
+        results = lookup.queryBatchIter(queries, store=False)
+        try:
+            for result in results:
+                # Skip any servers the coordinator has given up on
+                for message in connection.receive():
+                    if 'skip' in message:
+                        lookup.engine.skip({'ip': message['skip']})
+                if connection.closed:
+                    return
+
+                self.request.setblocking(True)
+                connection.send({
+                    'ip': result['server']['ip'],
+                    'query': index[(result['domain'], result['recordType'])],
+                    'results': result['results'],
+                    'success': result['success'],
+                    'rtt': result['rtt'],
+                    'retried': result['retried'],
+                    'ttl': result.get('ttl')
+                })
+                self.request.setblocking(False)
+
+            self.request.setblocking(True)
+            connection.send({'done': True})
+        except socket.error as e:
+            logging.warning("Lost connection to {0}: {1}".format(
+                self.client_address[0], e))
+        finally:
+            results.close()
+
+
+class AgentServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """
+    Listen for jobs from coordinators, each in its own thread
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, lookupFactory, key=None):
+        """
+        @param  address:        (host, port) to listen on
+        @param  lookupFactory:  Called to get a fresh L{dnsyo.lookup} for
+                                each job
+        @param  key:            Only run jobs that come with this key
+        """
+
+        socketserver.TCPServer.__init__(self, address, AgentHandler)
+        self.lookupFactory = lookupFactory
+        self.key = key
+
+
+def serveAgent(address, lookupFactory, key=None):
+    """
+    Run an agent until it's interrupted
+
+    Anyone who can connect to an agent can use it to send DNS queries, so
+    keep it on a private network and/or set a key.
+
+    @param  address:        `host:port` (or just the port) to listen on
+    @param  lookupFactory:  Called to get a fresh L{dnsyo.lookup} for each
+                            job
+    @param  key:            Only run jobs that come with this key
+
+    @type   address:        str
+    @type   lookupFactory:  callable
+    @type   key:            str
+    """
+
+    server = AgentServer(parseAddress(address), lookupFactory, key)
+
+    logging.info("Agent listening on {0}:{1}".format(
+        *server.server_address[:2]))
+
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
@@ -0,0 +1,219 @@
+"""
+Split a run across several processes
+
+The MIT License (MIT)
+
+Copyright (c) 2013 Sam Rudge (sam@codesam.co.uk)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import logging
+import time
+from .engine import QueryEngine
+
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+
+def _shardWorker(servers, queries, settings, results, skips):
+    """
+    Run one shard of the servers through its own L{QueryEngine}, sending
+    the results back in chunks
+    """
+
+    engine = QueryEngine(
+        maxInFlight=settings['maxInFlight'],
+        timeout=settings['timeout'],
+        health=settings['health'],
+        maxRate=settings['maxRate']
+    )
+    engine.port = settings['port']
+
+    chunk = []
+    lastSent = time.time()
+
+    engine.start(servers, queries)
+    try:
+        while not engine.finished:
+            while True:
+                try:
+                    engine.skip({'ip': skips.get_nowait()})
+                except Empty:
+                    break
+
+            chunk += engine.poll(wait=ShardedEngine.flushEvery)
+
+            if chunk and (
+                len(chunk) >= ShardedEngine.chunkSize or
+                time.time() - lastSent >= ShardedEngine.flushEvery
+            ):
+                results.put(chunk)
+                chunk = []
+                lastSent = time.time()
+    finally:
+        engine.close()
+
+    results.put(chunk)
+    results.put(None)
+
+
+class ShardedEngine(object):
+    """
+    Query a list of servers from several processes at once
+
+    Works like a L{QueryEngine}, but the servers are dealt out between
+    worker processes that each run their own engine, so parsing the
+    responses isn't limited to one core. Results are passed back to this
+    process in chunks and yielded as they arrive, so they can be colated
+    in one place.
+
+    The in flight and rate limits are split evenly between the workers.
+
+    @cvar   chunkSize:      Results a worker collects before sending them
+    @cvar   flushEvery:     Seconds a worker waits before sending a chunk
+                            that isn't full
+    """
+
+    chunkSize = 200
+    flushEvery = 0.1
+
+    def __init__(self, processes, maxInFlight=100, timeout=None, health=None,
+                 maxRate=None):
+        """
+        Setup the engine
+
+        @param  processes:      Number of worker processes
+        @param  maxInFlight:    Maximum number of queries waiting for a
+                                response at once, across all the workers
+        @param  timeout:        Override the default per server timeout
+        @param  health:         Past response times for each server
+        @param  maxRate:        Maximum packets to send per second across
+                                all the workers, None for no limit
+
+        @type   processes:      int
+        @type   maxInFlight:    int
+        @type   timeout:        int
+        @type   health:         L{dnsyo.health.HealthStore}
+        @type   maxRate:        float
+        """
+
+        self.processes = processes
+        self.maxInFlight = maxInFlight
+        self.timeout = timeout if timeout is not None else \
+            QueryEngine.timeout
+        self.health = health
+        self.maxRate = maxRate
+
+        self._workers = []
+        self._skips = []
+
+    def run(self, servers, queries):
+        """
+        Query every server in the list, yielding each result as soon as
+        it's passed back from its worker
+
+        @param  servers:    Servers to query
+        @param  queries:    (domain, record type) pairs to ask each server
+
+        @type   servers:    list
+        @type   queries:    list
+
+        @return:            Generator of results
+        """
+
+        # Most runs are never split, so don't import it until one is
+        import multiprocessing
+
+        processes = max(1, min(self.processes, len(servers)))
+        settings = {
+            'maxInFlight': max(1, self.maxInFlight // processes),
+            'maxRate': self.maxRate / processes if self.maxRate else None,
+            'timeout': self.timeout,
+            'health': self.health,
+            'port': QueryEngine.port
+        }
+
+        results = multiprocessing.Queue()
+
+        logging.debug("Splitting {0} servers between {1} processes".format(
+            len(servers), processes))
+
+        for i in range(processes):
+            skips = multiprocessing.Queue()
+            worker = multiprocessing.Process(
+                target=_shardWorker,
+                # Deal the servers out so each worker gets a similar mix
+                args=(servers[i::processes], queries, settings, results,
+                      skips)
+            )
+            worker.daemon = True
+            worker.start()
+
+            self._workers.append(worker)
+            self._skips.append(skips)
+
+        try:
+            running = processes
+            while running:
+                try:
+                    chunk = results.get(timeout=self.timeout)
+                except Empty:
+                    # A worker that died won't say it's finished
+                    alive = len([w for w in self._workers if w.is_alive()])
+                    if alive < running and results.empty():
+                        logging.warning("{0} query processes exited without "
+                                        "finishing".format(running - alive))
+                        running = alive
+                    continue
+
+                if chunk is None:
+                    running -= 1
+                    continue
+
+                for result in chunk:
+                    yield result
+        finally:
+            self.close()
+
+    def skip(self, server):
+        """
+        Don't send any more queries to a server this run
+
+        @param  server: The server to skip
+        @type   server: dict
+        """
+
+        for skips in self._skips:
+            skips.put(server['ip'])
+
+    def close(self):
+        """
+        Stop all the workers, anything still pending is abandoned
+        """
+
+        for worker in self._workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
+
+        self._workers = []
+        self._skips = []
@@ -0,0 +1,232 @@
+"""
+Timings and response time stats for a run
+
+The MIT License (MIT)
+
+Copyright (c) 2013 Sam Rudge (sam@codesam.co.uk)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import json
+import time
+from contextlib import contextmanager
+from .utils import atomicWrite
+
+
+class RunStats(object):
+    """
+    How long each part of a run took, and how quickly servers responded
+
+    Phases are timed separately and can overlap, `query` covers the
+    whole of a query run, including the time the engine spends in
+    `dispatch` (sending), `wait` (waiting for replies) and `receive`
+    (reading and parsing them).
+
+    @cvar   buckets:        Upper bounds, in seconds, of the response
+                            time histogram
+    @cvar   percentiles:    Response time percentiles to report
+    """
+
+    buckets = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1,
+               2.5, 5, 10]
+    percentiles = [50, 90, 95, 99]
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """
+        Clear out everything recorded so far
+        """
+
+        self.started = time.time()
+        self.phases = {}
+        self.rtts = []
+        self.servers = {}
+        self.outcomes = {}
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Time a block of code as a phase, times for the same phase add up
+
+            with stats.phase('prepareList'):
+                ...
+        """
+
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+
+    def add(self, name, seconds):
+        """
+        Add some time to a phase
+        """
+
+        phase = self.phases.get(name)
+        if phase is None:
+            phase = self.phases[name] = {'seconds': 0.0, 'count': 0}
+
+        phase['seconds'] += seconds
+        phase['count'] += 1
+
+    def observe(self, result):
+        """
+        Record a server's result
+
+        @param  result: A result from L{dnsyo.engine.QueryEngine}
+        @type   result: dict
+        """
+
+        outcome = 'success' if result['success'] else result['results'][0]
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+
+        if result.get('rtt') is not None:
+            self.rtts.append(result['rtt'])
+            self.servers[result['server']['ip']] = result['rtt']
+
+    def histogram(self):
+        """
+        Response time histogram
+
+        @return:    (upper bound, cumulative count) for each bucket, the
+                    last bound is None for everything
+        @rtype:     list
+        """
+
+        rtts = sorted(self.rtts)
+
+        counts = []
+        i = 0
+        for bound in self.buckets:
+            while i < len(rtts) and rtts[i] <= bound:
+                i += 1
+            counts.append((bound, i))
+        counts.append((None, len(rtts)))
+
+        return counts
+
+    def percentile(self, percent):
+        """
+        Response time at a percentile, None if nothing has responded
+        """
+
+        rtts = sorted(self.rtts)
+        if not rtts:
+            return None
+
+        return rtts[min(len(rtts) - 1, int(len(rtts) * percent / 100.0))]
+
+    def asDict(self, servers=False):
+        """
+        Everything recorded, ready to be dumped as JSON
+
+        @param  servers:    Include each server's latest response time
+        @rtype:             dict
+        """
+
+        rtts = self.rtts
+
+        stats = {
+            'started': self.started,
+            'wall': time.time() - self.started,
+            'phases': self.phases,
+            'outcomes': self.outcomes,
+            'rtt': {
+                'count': len(rtts),
+                'sum': sum(rtts),
+                'min': min(rtts) if rtts else None,
+                'max': max(rtts) if rtts else None,
+                'percentiles': dict([
+                    ('p{0}'.format(p), self.percentile(p))
+                    for p in self.percentiles]),
+                'histogram': [
+                    {'le': bound, 'count': count}
+                    for bound, count in self.histogram()]
+            }
+        }
+
+        if servers:
+            stats['servers'] = self.servers
+
+        return stats
+
+    def writeJSON(self, location, servers=True):
+        """
+        Write the stats out as JSON
+        """
+
+        atomicWrite(location, json.dumps(
+            self.asDict(servers), indent=2, sort_keys=True))
+
+    def prometheus(self):
+        """
+        The stats in the Prometheus text format
+
+        @rtype: str
+        """
+
+        out = [
+            "# HELP dnsyo_phase_seconds Seconds spent in each phase of the "
+            "last run",
+            "# TYPE dnsyo_phase_seconds gauge"
+        ]
+        for name, phase in sorted(self.phases.items()):
+            out.append('dnsyo_phase_seconds{{phase="{0}"}} {1}'.format(
+                name, repr(phase['seconds'])))
+
+        out += [
+            "# HELP dnsyo_responses Servers giving each outcome in the last "
+            "run",
+            "# TYPE dnsyo_responses gauge"
+        ]
+        for outcome, count in sorted(self.outcomes.items()):
+            out.append('dnsyo_responses{{outcome="{0}"}} {1}'.format(
+                outcome.replace('"', '\\"'), count))
+
+        out += [
+            "# HELP dnsyo_rtt_seconds Server response times in the last run",
+            "# TYPE dnsyo_rtt_seconds histogram"
+        ]
+        for bound, count in self.histogram():
+            out.append('dnsyo_rtt_seconds_bucket{{le="{0}"}} {1}'.format(
+                '+Inf' if bound is None else repr(bound), count))
+        out.append('dnsyo_rtt_seconds_sum {0}'.format(
+            repr(sum(self.rtts))))
+        out.append('dnsyo_rtt_seconds_count {0}'.format(len(self.rtts)))
+
+        out += [
+            "# HELP dnsyo_last_run_timestamp_seconds When the last run "
+            "started",
+            "# TYPE dnsyo_last_run_timestamp_seconds gauge",
+            "dnsyo_last_run_timestamp_seconds {0}".format(repr(self.started))
+        ]
+
+        return "\n".join(out) + "\n"
+
+    def writePrometheus(self, location):
+        """
+        Write the stats to a file for the node exporter's textfile
+        collector, it's replaced in one go so it's never read half written
+        """
+
+        atomicWrite(location, self.prometheus())
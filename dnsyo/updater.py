@@ -26,7 +26,6 @@ THE SOFTWARE.
 
 import logging
 import os
-import yaml
 
 
 class update(object):
@@ -34,6 +33,8 @@ class update(object):
 
     @cvar   testRecords:    List of records to test and, optionally the
                             expected result(s)
+    @cvar   dropAfter:      Stop testing a server after it's timed out
+                            this many times without passing a test
     """
 
     testRecords = [
@@ -63,6 +64,8 @@ class update(object):
         }
     ]
 
+    dropAfter = 2
+
     def __init__(self, lookup, summaryFile, outputFile):
         """
         Create an instance of the updater
@@ -83,7 +86,7 @@ class update(object):
         self.summaryFile = summaryFile
         self.outputFile = outputFile
 
-        foundServers = []
+        foundServers = set()
         duplicateServers = []
 
         for s in self.sourceServers:
@@ -93,7 +96,7 @@ class update(object):
                 ))
                 duplicateServers.append(s['ip'])
             else:
-                foundServers.append(s['ip'])
+                foundServers.add(s['ip'])
 
         if len(duplicateServers) > 0:
             raise Exception("{0} duplicate servers in source file!".format(
@@ -114,35 +117,66 @@ class update(object):
         """
         Query all the servers in the source list against the test records
 
-        Runs a L{dnsyo.lookup.query} against the test records and validates the
-        results to determine which servers are still alive, then writes the
-        results to the destination file and generates a summary.
+        Runs all the test records together in one L{dnsyo.lookup.queryBatch}
+        and validates the results to determine which servers are still
+        alive, then writes the results to the destination file and
+        generates a summary.
+
+        A server is kept if it passes any of the tests. Servers that keep
+        timing out before they've passed one are dropped from the rest of
+        the run.
         """
 
-        serverFailures = {}
+        serverPasses = {}
+        serverTimeouts = {}
         for s in self.sourceServers:
-            serverFailures[s['ip']] = 0
+            serverPasses[s['ip']] = 0
+            serverTimeouts[s['ip']] = 0
 
+        tests = {}
         for test in self.testRecords:
-            logging.info("Running test query {0}".format(test['query']))
-            self.lookup.query(*test['query'], progress=False)
-
-            for result in self.lookup.resultsColated:
-                if not result['success'] or (
-                    test.get('result') and
-                    not test['result'] in result['results']
+            tests[(test['query'][0], test['query'][1].upper())] = test
+
+        logging.info("Running {0} test queries".format(len(tests)))
+
+        for result in self.lookup.queryBatchIter(
+            [test['query'] for test in self.testRecords],
+            store=False
+        ):
+            ip = result['server']['ip']
+
+            if self.passed(
+                tests[(result['domain'], result['recordType'])],
+                result
+            ):
+                serverPasses[ip] += 1
+            elif result['results'] == ('Server Timeout',):
+                serverTimeouts[ip] += 1
+
+                # A server that's passed anything is working, it's just
+                # losing packets, so it keeps going
+                if serverTimeouts[ip] == self.dropAfter and \
+                        not serverPasses[ip]:
+                    logging.debug("Dropping {0}, timed out {1} "
+                                  "times".format(ip, self.dropAfter))
+                    self.lookup.engine.skip(result['server'])
+
+        for query in self.lookup.batch:
+            for result in query.resultsColated:
+                if not self.passed(
+                    tests[(query.domain, query.recordType)],
+                    result
                 ):
-                    logging.warning("{0} servers failed ({1})".format(
+                    logging.warning("{0} servers failed {1} {2} ({3})".format(
                         len(result['servers']),
+                        query.domain,
+                        query.recordType,
                         ",".join(result['results'])
                     ))
 
-                    for s in result['servers']:
-                        serverFailures[s['ip']] += 1
-
         passedServers = [
             s for s in self.sourceServers
-            if serverFailures[s['ip']] < len(self.testRecords)
+            if serverPasses[s['ip']]
         ]
 
         logging.info("Tested {0} servers, found {1} working".format(
@@ -160,13 +194,16 @@ class update(object):
             len(currentResolvers)
         ))
 
+        currentKeys = set([self.serverKey(s) for s in currentResolvers])
+        passedKeys = set([self.serverKey(s) for s in passedServers])
+
         serversRemoved = [
             s for s in currentResolvers
-            if s not in passedServers
+            if self.serverKey(s) not in passedKeys
         ]
         serversAdded = [
             s for s in passedServers
-            if s not in currentResolvers
+            if self.serverKey(s) not in currentKeys
         ]
 
         # Generate the summary file
@@ -194,17 +231,49 @@ class update(object):
                     ]))
                     f.write("\n\n")
 
+        # Slow to import, and only needed at the end
+        import yaml
+
+        # Use the C yaml emitter if it's available, it's much faster
+        try:
+            from yaml import CSafeDumper as SafeDumper
+        except ImportError:
+            from yaml import SafeDumper
+
         # Write out the destination file
         with open(os.path.expanduser(self.outputFile), 'w') as f:
             f.write("""# List of known *working* servers
 # Working server list is calculated fortnightly
 # If you'd like to add a new server, add it to resolver-list-sources.yml
 """)
-            f.write(yaml.safe_dump(
-                sorted(
+            f.write(yaml.dump(
+                [dict(s) for s in sorted(
                     passedServers,
                     key=lambda k: k['provider']
-                ),
+                )],
+                Dumper=SafeDumper,
                 indent=2,
                 default_flow_style=False
             ))
+
+    def passed(self, test, result):
+        """
+        Check if a result (or colated result) passes a test
+
+        @param  test:   One of the L{testRecords}
+        @param  result: Result for the test query
+
+        @rtype:         bool
+        """
+
+        return result['success'] and (
+            not test.get('result') or
+            test['result'] in result['results']
+        )
+
+    def serverKey(self, server):
+        """
+        Hashable version of a server entry, for comparing lists
+        """
+
+        return tuple(sorted(server.items()))
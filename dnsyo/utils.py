@@ -0,0 +1,125 @@
+"""
+Helpers for reading and writing dnsyo's files
+
+The MIT License (MIT)
+
+Copyright (c) 2013 Sam Rudge (sam@codesam.co.uk)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import errno
+import os
+import tempfile
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+def atomicWrite(path, data, mode='w', like=None):
+    """
+    Write a file so nothing ever sees it half written
+
+    The data goes to a temporary file in the same directory, which is
+    then renamed over the top of the target. It gets the target's
+    permissions, or the usual ones for a new file if there's no target
+    (temporary files are only readable by us)
+
+    @param  path:   File to write
+    @param  data:   Contents of the file
+    @param  mode:   Mode to open the file with, w or wb
+    @param  like:   File to take the permissions from instead of the
+                    target, for files kept alongside another one
+    """
+
+    fd, tmpPath = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)),
+        prefix='.' + os.path.basename(path) + '.'
+    )
+
+    try:
+        with os.fdopen(fd, mode) as f:
+            f.write(data)
+
+        os.chmod(tmpPath, _permissions(like or path))
+
+        if os.name == 'nt' and os.path.exists(path):
+            # Windows won't rename over an existing file
+            os.remove(path)
+        os.rename(tmpPath, path)
+    except BaseException:
+        if os.path.exists(tmpPath):
+            os.remove(tmpPath)
+        raise
+
+
+def _permissions(path):
+    """
+    Permissions a file written over path should have
+
+    @param  path:   File that's about to be written
+
+    @return:        The existing file's permission bits, or 0666 less the
+                    umask for a new file
+    @rtype:         int
+    """
+
+    try:
+        return os.stat(path).st_mode & 0o7777
+    except OSError:
+        # The umask can only be read by setting it
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0o666 & ~umask
+
+
+def lockFile(path, blocking=True):
+    """
+    Take an exclusive lock on a file, so only one process does something
+    at a time
+
+    On platforms without fcntl there's no locking, it always succeeds
+
+    @param  path:       Lock file, created if it doesn't exist
+    @param  blocking:   Wait for the lock if someone else has it
+
+    @return:            The open lock file, close it to release the lock,
+                        or None if it's locked and blocking is False
+    """
+
+    lf = open(path, 'a')
+
+    if fcntl is None:
+        return lf
+
+    flags = fcntl.LOCK_EX
+    if not blocking:
+        flags |= fcntl.LOCK_NB
+
+    try:
+        fcntl.flock(lf.fileno(), flags)
+    except IOError as e:
+        lf.close()
+        if e.errno in (errno.EAGAIN, errno.EACCES, errno.EWOULDBLOCK):
+            return None
+        raise
+
+    return lf
@@ -0,0 +1,661 @@
+#!/usr/bin/env python
+
+"""
+Benchmark DNSYO against a farm of fake resolvers on loopback
+
+Starts a fake resolver on each of thousands of loopback addresses
+(127.100.0.1 upwards), writes a resolver list for them, then times
+loading the list, querying, colating the results and a list update at
+each size. Nothing leaves the machine, so runs are repeatable.
+
+Each fake resolver is given a behaviour up front, from the fractions
+passed in; answer normally, answer with a different address, say
+NXDOMAIN or never answer. Every reply is delayed by the latency (plus
+jitter) and any packet can be lost.
+
+The farm can also be given the behaviour of each resolver outright,
+including a few more that the benchmark doesn't use but the checks in
+scripts/check.py do; always truncate over UDP and answer over TCP,
+reject EDNS queries with a bare FORMERR, or reply to a different
+question than was asked.
+
+    scripts/benchmark.py --sizes 100,1000,10000 --json results.json
+
+The MIT License (MIT)
+
+Copyright (c) 2013 Sam Rudge (sam@codesam.co.uk)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+from argparse import ArgumentParser
+import errno
+import gc
+import heapq
+import json
+import logging
+import multiprocessing
+import os
+import random
+import select
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import yaml
+
+try:
+    from yaml import CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeDumper
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# Benchmark the checkout this script is in, not an installed copy
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from dnsyo.dnsyo import lookup  # noqa: E402
+from dnsyo.engine import QueryEngine  # noqa: E402
+from dnsyo.updater import update  # noqa: E402
+
+# Slow to import, and only needed by some runs
+deferredModules = ['requests', 'pkg_resources', 'multiprocessing', 'yaml',
+                   'socketserver', 'http.server', 'dnsyo.updater',
+                   'dnsyo.daemon']
+
+
+def farmAddress(index):
+    """
+    Loopback address of the fake resolver with this index
+    """
+
+    index += 1
+    return '127.{0}.{1}.{2}'.format(
+        100 + (index >> 16), (index >> 8) & 0xff, index & 0xff)
+
+
+class ResolverFarm(object):
+    """
+    Lots of fake resolvers, served from a separate process
+
+    @cvar   countries:  Countries to spread the fake resolvers between
+    @cvar   providers:  Number of fake providers
+    @cvar   answers:    The normal answer, and the one divergent resolvers
+                        give instead
+    @cvar   txt:        Strings in the answer to TXT queries, too long to
+                        fit in a reply without EDNS
+    @cvar   ttl:        TTL of the answers
+    """
+
+    countries = ['US', 'GB', 'DE', 'FR', 'JP', 'BR', 'AU', 'IN']
+    providers = 50
+    answers = ('192.0.2.1', '192.0.2.2')
+    txt = tuple('record {0} '.format(i) + 'x' * 200 for i in range(3))
+    ttl = 300
+
+    def __init__(self, count=None, port=5399, latency=0.005, jitter=0.002,
+                 loss=0, divergence=0, nxdomain=0, dead=0, seed=1,
+                 behaviours=None):
+        """
+        Setup the farm
+
+        @param  count:      Number of fake resolvers
+        @param  port:       Port they listen on
+        @param  latency:    Seconds before each reply is sent
+        @param  jitter:     Standard deviation of the latency
+        @param  loss:       Fraction of queries to drop
+        @param  divergence: Fraction of resolvers that give a different
+                            answer
+        @param  nxdomain:   Fraction of resolvers that say NXDOMAIN
+        @param  dead:       Fraction of resolvers that never answer
+        @param  seed:       Seed for picking each resolver's behaviour
+        @param  behaviours: The behaviour of each resolver, instead of
+                            picking them from the fractions; `ok`,
+                            `divergent`, `nxdomain`, `dead`, `truncate`,
+                            `noEdns` or `wrongQuestion`
+        """
+
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+
+        if behaviours is not None:
+            self.behaviours = list(behaviours)
+        else:
+            rand = random.Random(seed)
+            self.behaviours = []
+            for i in range(count):
+                roll = rand.random()
+                if roll < dead:
+                    self.behaviours.append('dead')
+                elif roll < dead + nxdomain:
+                    self.behaviours.append('nxdomain')
+                elif roll < dead + nxdomain + divergence:
+                    self.behaviours.append('divergent')
+                else:
+                    self.behaviours.append('ok')
+
+        self.count = len(self.behaviours)
+        self.process = None
+
+    def serverList(self, count=None):
+        """
+        Resolver list entries for the first `count` fake resolvers
+        """
+
+        return [
+            {
+                'ip': farmAddress(i),
+                'country': self.countries[i % len(self.countries)],
+                'provider': 'AS{0} - Fake Provider {0}'.format(
+                    64512 + i % self.providers),
+                'reverse': 'resolver{0}.example.net'.format(i)
+            }
+            for i in range(self.count if count is None else count)
+        ]
+
+    def writeList(self, location, count=None):
+        """
+        Write a resolver list for the first `count` fake resolvers
+        """
+
+        with open(location, 'w') as f:
+            yaml.dump(self.serverList(count), f, Dumper=SafeDumper,
+                      default_flow_style=False)
+
+    def start(self):
+        """
+        Start the farm, returns once every resolver is listening
+        """
+
+        ready = multiprocessing.Event()
+        self.process = multiprocessing.Process(target=self._serve,
+                                               args=(ready,))
+        self.process.daemon = True
+        self.process.start()
+
+        if not ready.wait(120):
+            self.stop()
+            raise EnvironmentError("Fake resolvers didn't start")
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+            self.process = None
+
+    def _serve(self, ready):
+        """
+        Answer queries until we're stopped
+        """
+
+        # Every resolver needs its own socket
+        if resource is not None:
+            soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+            if hard == resource.RLIM_INFINITY or hard > self.count + 100:
+                wanted = self.count + 100
+            else:
+                wanted = hard
+            if soft != resource.RLIM_INFINITY and soft < wanted:
+                resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+
+        sockets = {}
+        listeners = {}
+        connections = {}
+        poller = select.poll()
+        for i in range(self.count):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind((farmAddress(i), self.port))
+            sock.setblocking(False)
+            sockets[sock.fileno()] = (sock, self.behaviours[i])
+            poller.register(sock.fileno(), select.POLLIN)
+
+            # Only resolvers that truncate everything are asked over TCP
+            if self.behaviours[i] == 'truncate':
+                listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR,
+                                    1)
+                listener.bind((farmAddress(i), self.port))
+                listener.listen(50)
+                listeners[listener.fileno()] = listener
+                poller.register(listener.fileno(), select.POLLIN)
+
+        ready.set()
+
+        rand = random.Random()
+        waiting = []
+
+        while True:
+            timeout = 100
+            if waiting:
+                timeout = max(0, int((waiting[0][0] - time.time()) * 1000))
+
+            for fd, event in poller.poll(timeout):
+                if fd in listeners:
+                    connection, source = listeners[fd].accept()
+                    connections[connection.fileno()] = [connection, b'']
+                    poller.register(connection.fileno(), select.POLLIN)
+                    continue
+                elif fd in connections:
+                    self._serveTcp(poller, connections, fd)
+                    continue
+
+                sock, behaviour = sockets[fd]
+                while True:
+                    try:
+                        query, source = sock.recvfrom(4096)
+                    except socket.error as e:
+                        if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                            break
+                        raise
+
+                    if behaviour == 'dead' or rand.random() < self.loss:
+                        continue
+
+                    reply = self._reply(behaviour, query)
+                    if reply is None:
+                        continue
+
+                    delay = max(0, rand.gauss(self.latency, self.jitter))
+                    heapq.heappush(waiting,
+                                   (time.time() + delay, fd, reply, source))
+
+            now = time.time()
+            while waiting and waiting[0][0] <= now:
+                due, fd, reply, source = heapq.heappop(waiting)
+                try:
+                    sockets[fd][0].sendto(reply, source)
+                except socket.error:
+                    pass
+
+    def _serveTcp(self, poller, connections, fd):
+        """
+        Answer whatever queries have arrived on a TCP connection, straight
+        away and in order
+        """
+
+        connection = connections[fd]
+
+        try:
+            data = connection[0].recv(65535)
+        except socket.error:
+            data = b''
+
+        if not data:
+            poller.unregister(fd)
+            connection[0].close()
+            del connections[fd]
+            return
+
+        connection[1] += data
+        while len(connection[1]) >= 2:
+            length = struct.unpack('!H', connection[1][:2])[0]
+            if len(connection[1]) < length + 2:
+                break
+
+            query = connection[1][2:length + 2]
+            connection[1] = connection[1][length + 2:]
+
+            reply = self._reply('ok', query)
+            if reply is not None:
+                connection[0].sendall(struct.pack('!H', len(reply)) + reply)
+
+    def _reply(self, behaviour, query):
+        """
+        Build the reply to a query by hand, it's much quicker than
+        dnspython and the farm needs to keep up with the client
+        """
+
+        data = bytearray(query)
+        if len(data) < 17:
+            return None
+
+        # Find the end of the question
+        end = 12
+        while end < len(data) and data[end]:
+            end += data[end] + 1
+        end += 5
+        if end > len(data):
+            return None
+
+        qtype = struct.unpack('!H', query[end - 4:end - 2])[0]
+        additional = struct.unpack('!H', query[10:12])[0]
+
+        flags = 0x8000 | (data[2] & 0x01) << 8 | 0x80
+        if behaviour == 'noEdns' and additional:
+            # Just the header, like a lot of servers that don't know what
+            # the OPT record is
+            return query[:2] + struct.pack('!HHHHH', flags | 1, 0, 0, 0, 0)
+
+        question = query[12:end]
+        if behaviour == 'wrongQuestion' and data[12]:
+            # A different first letter
+            question = bytearray(question)
+            question[1] ^= 1
+            question = bytes(question)
+
+        answers = []
+        if behaviour == 'nxdomain':
+            flags |= 3
+        elif behaviour == 'truncate':
+            # Everything has to be asked again over TCP
+            flags |= 0x200
+        elif qtype == 1:
+            address = self.answers[1 if behaviour == 'divergent' else 0]
+            answers.append(self._record(1, socket.inet_aton(address)))
+        elif qtype == 16:
+            for text in self.txt:
+                answers.append(self._record(
+                    16, struct.pack('!B', len(text)) + text.encode('ascii')))
+
+        return query[:2] + struct.pack(
+            '!HHHHH', flags, 1, len(answers), 0, 0) + \
+            question + b''.join(answers)
+
+    def _record(self, rdtype, rdata):
+        """
+        An answer record for the name in the question
+        """
+
+        return b'\xc0\x0c' + struct.pack(
+            '!HHIH', rdtype, 1, self.ttl, len(rdata)) + rdata
+
+
+def measure(name, servers, work, count):
+    """
+    Time a benchmark
+
+    @param  name:       What's being measured
+    @param  servers:    How many servers it's measured at
+    @param  work:       Function to time
+    @param  count:      Number of things work does, for the throughput
+
+    @return:            The measurements
+    @rtype:             dict
+    """
+
+    # Sample the thread count while it runs, not counting the sampler
+    threads = [threading.active_count()]
+    running = threading.Event()
+    running.set()
+
+    def sample():
+        while running.is_set():
+            threads.append(threading.active_count() - 1)
+            time.sleep(0.01)
+
+    sampler = threading.Thread(target=sample)
+    sampler.daemon = True
+
+    gc.collect()
+    if tracemalloc is not None:
+        tracemalloc.start()
+
+    sampler.start()
+    start = time.time()
+    try:
+        work()
+    finally:
+        wall = time.time() - start
+        running.clear()
+        sampler.join()
+
+    peak = None
+    if tracemalloc is not None:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return {
+        'benchmark': name,
+        'servers': servers,
+        'wall': wall,
+        'perSecond': count / wall if wall else None,
+        'peakMemory': peak,
+        'maxRss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if resource is not None else None,
+        'threads': max(threads)
+    }
+
+
+def benchmarkSize(farm, size, workDir, opts):
+    """
+    Run all the benchmarks at one size
+    """
+
+    listFile = os.path.join(workDir, 'resolvers-{0}.yaml'.format(size))
+    farm.writeList(listFile, size)
+
+    def makeLookup():
+        return lookup(
+            listLocation='http://localhost/unused',
+            listLocal=listFile,
+            maxServers='ALL',
+            maxWorkers=opts.threads,
+            processes=opts.processes
+        )
+
+    runs = []
+    benchmarks = opts.benchmarks.split(',')
+
+    if 'prepareList' in benchmarks:
+        def cold():
+            lookup.loadedLists.clear()
+            if os.path.exists(listFile + lookup.cacheSuffix):
+                os.remove(listFile + lookup.cacheSuffix)
+            makeLookup().prepareList()
+
+        runs.append(measure('prepareList (cold)', size, cold, size))
+
+        def cached():
+            lookup.loadedLists.clear()
+            makeLookup().prepareList()
+
+        runs.append(measure('prepareList (cached)', size, cached, size))
+
+    results = []
+    if 'query' in benchmarks or 'colate' in benchmarks:
+        queried = makeLookup()
+        queried.prepareList()
+
+        def query():
+            queried.query(opts.domain, 'A', progress=False)
+
+        runs.append(measure('query', size, query, size))
+        results = queried.results
+
+    if 'colate' in benchmarks and results:
+        # Colating is quick, so do it enough times to measure
+        repeats = max(1, 100000 // len(results))
+        colated = makeLookup()
+
+        def colate():
+            for i in range(repeats):
+                colated._reset(opts.domain, 'A')
+                for result in results:
+                    colated.colate(result)
+
+        runs.append(measure('colate', size, colate, len(results) * repeats))
+
+    if 'update' in benchmarks:
+        updater = makeLookup()
+        summary = os.path.join(workDir, 'summary.txt')
+        destination = os.path.join(workDir, 'updated.yaml')
+
+        # The update is compared against the current list
+        shutil.copy(listFile, destination)
+
+        def listUpdate():
+            update(updater, summary, destination)
+
+        runs.append(measure('update', size, listUpdate,
+                            size * len(update.testRecords)))
+
+    return runs
+
+
+def benchmarkStartup(opts):
+    """
+    Time fresh processes importing the CLI, short runs spend most of their
+    time on this, and check the modules that should be imported only when
+    they're needed haven't crept back in
+    """
+
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    env = dict(os.environ, PYTHONPATH=root)
+    code = (
+        "import sys\n"
+        "import dnsyo.cli\n"
+        "sys.stdout.write(' '.join(m for m in {0!r} if m in sys.modules))\n"
+    ).format(deferredModules)
+
+    times = []
+    for i in range(opts.startupRuns):
+        start = time.time()
+        imported = subprocess.check_output(
+            [sys.executable, '-c', code], env=env).decode('utf-8').split()
+        times.append(time.time() - start)
+
+    if imported:
+        sys.stderr.write("Imported at start up, but shouldn't be: "
+                         "{0}\n".format(', '.join(imported)))
+
+    wall = sorted(times)[len(times) // 2]
+
+    return {
+        'benchmark': 'startup',
+        'servers': 0,
+        'wall': wall,
+        'perSecond': 1 / wall,
+        'peakMemory': None,
+        'maxRss': None,
+        'threads': 1,
+        'imported': imported
+    }
+
+
+def run():
+    p = ArgumentParser(
+        description="Benchmark DNSYO against fake resolvers on loopback"
+    )
+    p.add_argument('--sizes', default='100,1000,10000',
+                   help='Numbers of servers to benchmark with')
+    p.add_argument('--benchmarks',
+                   default='startup,prepareList,query,colate,update',
+                   help='Which benchmarks to run')
+    p.add_argument('--startupRuns', type=int, default=10,
+                   help='Processes to start for the startup benchmark, the '
+                   'median is reported')
+    p.add_argument('--port', type=int, default=5399,
+                   help='Port for the fake resolvers')
+    p.add_argument('--latency', type=float, default=5,
+                   help='Milliseconds before each reply')
+    p.add_argument('--jitter', type=float, default=2,
+                   help='Standard deviation of the latency in milliseconds')
+    p.add_argument('--loss', type=float, default=0,
+                   help='Fraction of packets to drop')
+    p.add_argument('--divergence', type=float, default=0.1,
+                   help='Fraction of resolvers giving a different answer')
+    p.add_argument('--nxdomain', type=float, default=0.05,
+                   help='Fraction of resolvers saying NXDOMAIN')
+    p.add_argument('--dead', type=float, default=0.02,
+                   help='Fraction of resolvers that never answer')
+    p.add_argument('--timeout', type=float, default=2,
+                   help='Seconds to wait for each server')
+    p.add_argument('--threads', type=int, default=100,
+                   help='Maximum number of queries in flight')
+    p.add_argument('--processes', type=int, default=1,
+                   help='Processes to split the queries across')
+    p.add_argument('--domain', default='example.com',
+                   help='Domain to query')
+    p.add_argument('--json', help='Also write the results to this file')
+    p.add_argument('--verbose', '-v', action='store_true')
+    opts = p.parse_args()
+
+    # The update warns about every test that failed, which is most of them
+    logging.basicConfig(
+        level=logging.DEBUG if opts.verbose else logging.ERROR)
+
+    sizes = [int(s) for s in opts.sizes.split(',')]
+
+    QueryEngine.port = opts.port
+    QueryEngine.timeout = opts.timeout
+
+    farm = ResolverFarm(
+        max(sizes),
+        port=opts.port,
+        latency=opts.latency / 1000.0,
+        jitter=opts.jitter / 1000.0,
+        loss=opts.loss,
+        divergence=opts.divergence,
+        nxdomain=opts.nxdomain,
+        dead=opts.dead
+    )
+
+    workDir = tempfile.mkdtemp(prefix='dnsyo-benchmark-')
+    runs = []
+
+    sys.stdout.write("Starting {0} fake resolvers...\n".format(max(sizes)))
+    farm.start()
+    try:
+        sys.stdout.write("{0:<22}{1:>8}{2:>10}{3:>12}{4:>14}{5:>9}\n".format(
+            'benchmark', 'servers', 'wall (s)', 'per second',
+            'peak mem (KB)', 'threads'))
+
+        def report(measured):
+            runs.append(measured)
+            sys.stdout.write(
+                "{0:<22}{1:>8}{2:>10.3f}{3:>12.0f}{4:>14}{5:>9}\n".format(
+                    measured['benchmark'], measured['servers'],
+                    measured['wall'], measured['perSecond'] or 0,
+                    measured['peakMemory'] // 1024
+                    if measured['peakMemory'] is not None else '-',
+                    measured['threads']))
+            sys.stdout.flush()
+
+        if 'startup' in opts.benchmarks.split(','):
+            report(benchmarkStartup(opts))
+
+        for size in sizes:
+            for measured in benchmarkSize(farm, size, workDir, opts):
+                report(measured)
+    finally:
+        farm.stop()
+        shutil.rmtree(workDir, ignore_errors=True)
+
+    if opts.json:
+        with open(opts.json, 'w') as f:
+            json.dump(runs, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    run()
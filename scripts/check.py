@@ -0,0 +1,412 @@
+#!/usr/bin/env python
+
+"""
+Check DNSYO behaves against a farm of fake resolvers on loopback
+
+Uses the same fake resolvers as the benchmark, with behaviours picked for
+each check rather than at random, so every server's result is known in
+advance. Nothing leaves the machine.
+
+    scripts/check.py
+    scripts/check.py engine agents
+
+Exits non-zero if any check fails.
+
+The MIT License (MIT)
+
+Copyright (c) 2013 Sam Rudge (sam@codesam.co.uk)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+from argparse import ArgumentParser
+import logging
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+# Check the checkout this script is in, not an installed copy
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from benchmark import ResolverFarm  # noqa: E402
+from dnsyo.dnsyo import lookup  # noqa: E402
+from dnsyo.engine import QueryEngine  # noqa: E402
+from dnsyo.records import Server  # noqa: E402
+from dnsyo.remote import AgentServer, LineSocket, RemoteEngine  # noqa: E402
+
+
+def expected(farm, index, recordType='A'):
+    """
+    The results a fake resolver should give for a query
+    """
+
+    behaviour = farm.behaviours[index]
+    if behaviour in ('dead', 'wrongQuestion'):
+        return ('Server Timeout',)
+    elif behaviour == 'nxdomain':
+        return ('NXDOMAIN',)
+    elif recordType == 'TXT':
+        return tuple(sorted('"{0}"'.format(t) for t in farm.txt))
+    elif recordType != 'A':
+        return ('No Answer',)
+    elif behaviour == 'divergent':
+        return (farm.answers[1],)
+
+    return (farm.answers[0],)
+
+
+def checkResults(farm, results, servers, queries):
+    """
+    Check there's exactly one result for each server and query, and it's
+    the one the server should give
+    """
+
+    indexes = dict((s['ip'], i) for i, s in enumerate(farm.serverList()))
+
+    seen = {}
+    for result in results:
+        key = (result['server']['ip'], result['domain'],
+               result['recordType'])
+        assert key not in seen, "{0} answered {1} {2} twice".format(*key)
+        seen[key] = result
+
+        want = expected(farm, indexes[key[0]], key[2])
+        assert result['results'] == want, \
+            "{0} gave {1} for {2} {3}, should be {4}".format(
+                key[0], result['results'], key[1], key[2], want)
+
+    assert len(seen) == len(servers) * len(queries), \
+        "{0} results for {1} queries".format(
+            len(seen), len(servers) * len(queries))
+
+    return seen
+
+
+def farmServers(farm, *behaviours):
+    """
+    The farm's servers, or just the ones with these behaviours
+    """
+
+    return [
+        Server(s['ip']) for s, behaviour in zip(farm.serverList(),
+                                                farm.behaviours)
+        if not behaviours or behaviour in behaviours]
+
+
+def engineMatching(farm, workDir):
+    """
+    Replies arriving in any order are matched back to the right server
+    and query, and replies to a different question are ignored
+    """
+
+    servers = farmServers(farm)
+    queries = [('example.com', 'A'), ('example.net', 'A')]
+
+    results = list(QueryEngine(maxInFlight=50).run(servers, queries))
+    checkResults(farm, results, servers, queries)
+
+    for result in results:
+        timedOut = result['results'] == ('Server Timeout',)
+        assert (result['rtt'] is None) == timedOut, \
+            "{0} has a response time of {1}".format(
+                result['server']['ip'], result['rtt'])
+
+
+def engineTimeouts(farm, workDir):
+    """
+    Servers that never answer time out, without holding up the rest
+    """
+
+    servers = farmServers(farm, 'ok', 'dead')
+    queries = [('example.com', 'A')]
+
+    started = time.time()
+    results = list(QueryEngine(maxInFlight=50).run(servers, queries))
+    took = time.time() - started
+
+    checkResults(farm, results, servers, queries)
+    assert took < QueryEngine.timeout + 1, \
+        "Took {0:.1f}s with a {1}s timeout".format(took, QueryEngine.timeout)
+
+
+def engineNegative(farm, workDir):
+    """
+    NXDOMAIN and empty answers are told apart
+    """
+
+    servers = farmServers(farm, 'ok', 'nxdomain')
+    queries = [('example.com', 'MX')]
+
+    results = list(QueryEngine().run(servers, queries))
+    checkResults(farm, results, servers, queries)
+
+
+def engineTruncation(farm, workDir):
+    """
+    Truncated answers are fetched over TCP, with one connection to each
+    server for all of its queries
+    """
+
+    servers = farmServers(farm, 'ok', 'truncate')
+    queries = [('example.com', 'TXT'), ('example.net', 'TXT'),
+               ('example.org', 'A')]
+
+    engine = QueryEngine()
+    connected = []
+    connect = engine._tcpConnect
+
+    def countConnections(family, ip, pooled=True):
+        connected.append(ip)
+        return connect(family, ip, pooled)
+
+    engine._tcpConnect = countConnections
+
+    results = list(engine.run(servers, queries))
+    checkResults(farm, results, servers, queries)
+
+    truncating = farmServers(farm, 'truncate')
+    assert sorted(connected) == sorted(s['ip'] for s in truncating), \
+        "{0} TCP connections for {1} servers that truncate".format(
+            len(connected), len(truncating))
+
+
+def engineEdnsFallback(farm, workDir):
+    """
+    Servers that reject EDNS queries with a bare FORMERR are asked again
+    without it, and get plain queries from then on
+    """
+
+    servers = farmServers(farm, 'ok', 'noEdns')
+    queries = [('example.com', 'A'), ('example.net', 'A')]
+
+    engine = QueryEngine()
+    results = list(engine.run(servers, queries))
+    checkResults(farm, results, servers, queries)
+
+    rejecting = set(s['ip'] for s in farmServers(farm, 'noEdns'))
+    assert engine._noEdns == rejecting, \
+        "{0} servers marked as not supporting EDNS, should be {1}".format(
+            len(engine._noEdns), len(rejecting))
+
+
+class Agents(object):
+    """
+    Agents listening on loopback, each running its jobs against the farm
+    """
+
+    def __init__(self, count, listFile):
+        def makeLookup():
+            return lookup(
+                listLocation='http://localhost/unused',
+                listLocal=listFile,
+                maxServers='ALL',
+                healthFile=None
+            )
+
+        self.servers = []
+        for i in range(count):
+            server = AgentServer(('127.0.0.1', 0), makeLookup)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            self.servers.append(server)
+
+        self.addresses = [
+            '127.0.0.1:{0}'.format(s.server_address[1]) for s in self.servers]
+
+    def stop(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+
+class DroppingAgent(object):
+    """
+    An agent that answers for the first few of its servers, then drops
+    the connection without finishing
+    """
+
+    def __init__(self, answered):
+        self.answered = answered
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(5)
+        self.address = '127.0.0.1:{0}'.format(
+            self.listener.getsockname()[1])
+        self.sent = []
+
+        thread = threading.Thread(target=self._serve)
+        thread.daemon = True
+        thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                sock, _ = self.listener.accept()
+            except socket.error:
+                return
+
+            connection = LineSocket(sock)
+            job = connection.readLine()
+            for ip in job['servers'][:self.answered]:
+                connection.send({'ip': ip, 'query': 0, 'success': False,
+                                 'results': ['Dropped'], 'rtt': None,
+                                 'retried': False, 'ttl': None})
+                self.sent.append(ip)
+            sock.close()
+
+    def stop(self):
+        self.listener.close()
+
+
+def agentAttribution(farm, workDir):
+    """
+    Every server is queried by the agent it was dealt to, and its result
+    says which one that was
+    """
+
+    agents = Agents(3, farm.listFile)
+    try:
+        servers = [Server(s['ip']) for s in farm.serverList()]
+        queries = [('example.com', 'A')]
+
+        results = list(RemoteEngine(agents.addresses).run(servers, queries))
+        seen = checkResults(farm, results, servers, queries)
+
+        for i, server in enumerate(servers):
+            agent = seen[(server['ip'], 'example.com', 'A')]['agent']
+            want = agents.addresses[i % len(agents.addresses)]
+            assert agent == want, "{0} was queried by {1}, not {2}".format(
+                server['ip'], agent, want)
+    finally:
+        agents.stop()
+
+
+def agentHandover(farm, workDir):
+    """
+    When an agent drops out part way through, the servers it hadn't
+    finished are queried by another agent
+    """
+
+    agents = Agents(2, farm.listFile)
+    dropping = DroppingAgent(5)
+    try:
+        servers = [Server(s['ip']) for s in farm.serverList()]
+        queries = [('example.com', 'A')]
+        addresses = agents.addresses + [dropping.address]
+
+        results = list(RemoteEngine(addresses).run(servers, queries))
+
+        # What the dropping agent sent back is kept, the rest of its share
+        # is done again by one of the others
+        dropped = [r for r in results if r['agent'] == dropping.address]
+        assert sorted(r['server']['ip'] for r in dropped) == \
+            sorted(dropping.sent), "Results from the dropped agent were lost"
+        assert len(dropping.sent) == 5, "The dropping agent didn't get a job"
+
+        rest = [r for r in results if r['agent'] != dropping.address]
+        checkResults(farm, rest, [
+            s for s in servers if s['ip'] not in dropping.sent], queries)
+
+        share = set(s['ip'] for s in servers[2::3])
+        handedOver = [r for r in rest if r['server']['ip'] in share]
+        assert len(handedOver) == len(share) - 5, \
+            "{0} of the dropped agent's servers were handed over, should " \
+            "be {1}".format(len(handedOver), len(share) - 5)
+        assert set(r['agent'] for r in handedOver) <= \
+            set(agents.addresses), "Servers handed to an unknown agent"
+    finally:
+        dropping.stop()
+        agents.stop()
+
+
+# Each group of checks, with the farm they're run against
+checks = [
+    ('engine', dict(behaviours=['ok', 'divergent', 'nxdomain', 'dead',
+                                'truncate', 'noEdns', 'wrongQuestion'] * 15,
+                    latency=0.01, jitter=0.005),
+     [engineMatching, engineTimeouts, engineNegative, engineTruncation,
+      engineEdnsFallback]),
+    ('agents', dict(count=60, nxdomain=0.1, dead=0.05, divergence=0.2),
+     [agentAttribution, agentHandover])
+]
+
+
+def run():
+    p = ArgumentParser(
+        description="Check DNSYO against fake resolvers on loopback"
+    )
+    p.add_argument('groups', nargs='*',
+                   help='Groups of checks to run ({0}), all by '
+                   'default'.format(', '.join(c[0] for c in checks)))
+    p.add_argument('--port', type=int, default=5398,
+                   help='Port for the fake resolvers')
+    p.add_argument('--verbose', '-v', action='store_true')
+    opts = p.parse_args()
+
+    logging.basicConfig(
+        level=logging.DEBUG if opts.verbose else logging.CRITICAL)
+
+    QueryEngine.port = opts.port
+    QueryEngine.timeout = 1
+
+    workDir = tempfile.mkdtemp(prefix='dnsyo-check-')
+    failed = 0
+
+    try:
+        for group, farmOptions, functions in checks:
+            if opts.groups and group not in opts.groups:
+                continue
+
+            farm = ResolverFarm(port=opts.port, **dict(
+                dict(latency=0.002, jitter=0.001), **farmOptions))
+            farm.listFile = os.path.join(workDir, group + '.yaml')
+            farm.writeList(farm.listFile)
+            farm.start()
+
+            try:
+                for function in functions:
+                    name = '{0}.{1}'.format(group, function.__name__)
+                    try:
+                        function(farm, workDir)
+                    except Exception:
+                        failed += 1
+                        sys.stdout.write("FAIL {0}\n".format(name))
+                        traceback.print_exc(file=sys.stdout)
+                    else:
+                        sys.stdout.write("ok   {0}\n".format(name))
+                    sys.stdout.flush()
+            finally:
+                farm.stop()
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+    if failed:
+        sys.stdout.write("{0} checks failed\n".format(failed))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    run()